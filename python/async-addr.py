@@ -5,6 +5,7 @@
 async-addr.py: asynchronously resolve given DNS names into IP addresses. 
 The -s switch constains answers to only ones secured by DNSSEC. 
 The -4 switch only returns IPv4 addresses, the -6 switch only IPv6 addresses.
+The -j switch prints one JSON object per name as each answer arrives.
 
 An example run:
 $ python async-addr.py www.panix.com www.isoc.org www.verisignlabs.com
@@ -21,21 +22,71 @@ www.isoc.org: IPv6 2001:41c8:20::19
 
 """
 
-import getdns, sys, getopt, os.path
+import getdns, sys, getopt, os.path, time, json
+
+extensions = { "return_both_v4_and_v6" : getdns.EXTENSION_TRUE }
+desired_addr_type = None
+json_output = False
+started = {}                                   # transaction id -> time
+
+status_names = dict((getattr(getdns, x), x[11:]) for x in dir(getdns)
+                    if x.startswith('RESPSTATUS_'))
+dnssec_names = dict((getattr(getdns, x), x[7:]) for x in dir(getdns)
+                    if x.startswith('DNSSEC_'))
+
+
+def print_json(hostname, status, latency, result=None, error=None):
+    """Write one JSON object with the outcome of an address lookup. A
+    lookup that could not be submitted has status ERROR and the error
+    message in error."""
+    answers = []
+    dnssec = None
+    if result is not None:
+        if status == getdns.RESPSTATUS_GOOD:
+            for addr in result.just_address_answers:
+                if (desired_addr_type == None) or \
+                   (addr['address_type'] == desired_addr_type):
+                    answers.append(addr['address_data'])
+        for reply in result.replies_tree:
+            if 'dnssec_status' in reply:
+                dnssec = dnssec or []
+                dnssec.append(dnssec_names.get(reply['dnssec_status'],
+                                               reply['dnssec_status']))
+    d = dict(qname=hostname, qtype='ADDRESS',
+             status=status_names.get(status, str(status)),
+             latency_ms=round(latency * 1000, 3),
+             answers=answers, dnssec=dnssec)
+    if error is not None:
+        d['error'] = error
+    sys.stdout.write(json.dumps(d, sort_keys=True) + '\n')
+
 
 def cbk(type, result, userarg, tid):
+    latency = time.time() - started.pop(tid, time.time())
+    if json_output:
+        if type == getdns.CALLBACK_COMPLETE:
+            print_json(userarg, result.status, latency, result)
+        elif type == getdns.CALLBACK_TIMEOUT:
+            print_json(userarg, 'TIMEOUT', latency)
+        elif type == getdns.CALLBACK_CANCEL:
+            print_json(userarg, 'CANCEL', latency)
+        else:
+            print_json(userarg, 'ERROR', latency)
+        return
     if type == getdns.CALLBACK_COMPLETE:
         status = result.status
         if status == getdns.RESPSTATUS_GOOD:
             for addr in result.just_address_answers:
                 addr_type = addr['address_type']
                 addr_data = addr['address_data']
-                print('{0}: {1} {2}'.format(userarg, addr_type, addr_data))
+                if (desired_addr_type == None) or \
+                   (addr_type == desired_addr_type):
+                    print('{0}: {1} {2}'.format(userarg, addr_type, addr_data))
         elif status == getdns.RESPSTATUS_NO_SECURE_ANSWERS:
-            print("%s: No DNSSEC secured responses found" % hostname)
+            print("%s: No DNSSEC secured responses found" % userarg)
         else:
             print("%s: getdns.address() returned error: %d" %
-                  (hostname, status))
+                  (userarg, status))
     elif type == getdns.CALLBACK_CANCEL:
         print('Callback cancelled')
     elif type == getdns.CALLBACK_TIMEOUT:
@@ -47,33 +98,50 @@ def cbk(type, result, userarg, tid):
 def usage():
     progname = os.path.basename(sys.argv[0])
     print("""\
-Usage: {0} [-s] [-4|-6] <domain1> <domain2> ...
+Usage: {0} [-s] [-4|-6] [-j] <domain1> <domain2> ...
 
     -s: only return DNSSEC secured answers
     -4: only return IPv4 address answers
     -6: only return IPv6 address answers
+    -j: print results as JSON lines: qname, qtype, status, latency_ms,
+        answers, dnssec
 
 -4 and -6 are mutually exclusive. If both are specified, IPv6 wins.
 """.format(progname))
     sys.exit(1)
 
 try:
-    (options, args) = getopt.getopt(sys.argv[1:], 's46')
+    (options, args) = getopt.getopt(sys.argv[1:], 's46j')
 except getopt.GetoptError:
     usage()
 else:
     if not args:
         usage()
 
-extensions = { "return_both_v4_and_v6" : getdns.EXTENSION_TRUE }
+for (opt, optval) in options:
+    if opt == "-s":
+        extensions["dnssec_return_only_secure"] = getdns.EXTENSION_TRUE
+    elif opt == "-4":
+        desired_addr_type = "IPv4"
+    elif opt == "-6":
+        desired_addr_type = "IPv6"
+    elif opt == "-j":
+        json_output = True
 
 ctx = getdns.Context()
 tids = []
 for hostname in args:
     try:
-        tids.append(ctx.address(name=hostname, extensions=extensions, callback='cbk', userarg=hostname))
-        print('DEBUG: submitted query for {0}'.format(hostname))
-    except (getdns.error, e):
-        print(str(e))
+        t0 = time.time()
+        tid = ctx.address(name=hostname, extensions=extensions, callback=cbk, userarg=hostname)
+        started[tid] = t0
+        tids.append(tid)
+        if not json_output:
+            print('DEBUG: submitted query for {0}'.format(hostname))
+    except getdns.error as e:
+        if json_output:
+            print_json(hostname, 'ERROR', time.time() - t0, error=str(e))
+        else:
+            print(str(e))
         break
 ctx.run()
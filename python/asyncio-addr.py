@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#
+
+"""
+asyncio-addr.py: resolve given DNS names into IP addresses concurrently
+from an asyncio event loop, using the getdns_asyncio adapter. The -s
+switch constains answers to only ones secured by DNSSEC.
+
+An example run:
+$ python3 asyncio-addr.py www.panix.com www.isoc.org
+
+www.panix.com: IPv4 166.84.62.125
+www.panix.com: IPv4 166.84.62.253
+www.isoc.org: IPv4 212.110.167.157
+www.isoc.org: IPv6 2001:41c8:20::19
+
+"""
+
+import asyncio, getdns, sys, getopt, os.path
+import getdns_asyncio
+
+
+def usage():
+    progname = os.path.basename(sys.argv[0])
+    print("""\
+Usage: {0} [-s] <domain1> <domain2> ...
+
+    -s: only return DNSSEC secured answers
+""".format(progname))
+    sys.exit(1)
+
+
+async def get_addresses(actx, hostname, extensions):
+    try:
+        results = await actx.address(hostname, extensions=extensions)
+    except (getdns.error, getdns_asyncio.QueryError) as e:
+        print("%s: %s" % (hostname, e))
+        return
+    except asyncio.TimeoutError:
+        print("%s: Query timed out" % hostname)
+        return
+    status = results.status
+    if status == getdns.RESPSTATUS_GOOD:
+        for addr in results.just_address_answers:
+            print('{0}: {1} {2}'.format(hostname, addr['address_type'],
+                                        addr['address_data']))
+    elif status == getdns.RESPSTATUS_NO_SECURE_ANSWERS:
+        print("%s: No DNSSEC secured responses found" % hostname)
+    else:
+        print("%s: getdns.address() returned error: %d" % (hostname, status))
+
+
+async def main(hostnames, extensions):
+    actx = getdns_asyncio.AsyncContext()
+    await asyncio.gather(*[get_addresses(actx, hostname, extensions)
+                           for hostname in hostnames])
+    await actx.close()
+
+
+if __name__ == '__main__':
+
+    try:
+        (options, args) = getopt.getopt(sys.argv[1:], 's')
+    except getopt.GetoptError:
+        usage()
+    else:
+        if not args:
+            usage()
+
+    extensions = { "return_both_v4_and_v6" : getdns.EXTENSION_TRUE }
+    for (opt, optval) in options:
+        if opt == "-s":
+            extensions["dnssec_return_only_secure"] = getdns.EXTENSION_TRUE
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args, extensions))
@@ -4,40 +4,56 @@
 """
 
 Validate a TLS certificate with DANE/DNSSEC.
-Due to limitations in current Python TLS libraries, only supports 
-TLSA usage=3 (DANE-EE).
+All four TLSA usages are supported, see dane.py: the trust anchor
+usages need the end-entity certificate to verify to the matched CA
+certificate, and the PKIX usages need the chain to validate against the
+system trust store.
+
+With -s <dir>, TLS sessions are cached in memory and in the given
+directory, and resumed on later connections to the same host and port
+(see sessioncache.py); resumption statistics are printed at the end.
+
+All addresses of the host are checked concurrently, one thread per
+address, each connection bounded by CONNECT_TIMEOUT seconds; results
+are printed in address order.
 
 """
 
-import os.path, sys, socket, hashlib
+import os.path, sys, socket, threading, getopt, time
 from M2Crypto import SSL, X509
+import M2Crypto.threading
 import getdns
+import dane
+import sessioncache
+
+
+CONNECT_TIMEOUT = 10                    # seconds, per address
 
 
 def usage():
     print("""\
-Usage: {0} <hostname> [<port>]\
+Usage: {0} [-s session_dir] <hostname> <port>
+
+    -s session_dir: cache TLS sessions in session_dir and resume them\
 """.format(os.path.basename(sys.argv[0])))
     sys.exit(1)
 
 
-def compute_hash(func, string):
-    """compute hash of string using given hash function"""
-    h = func()
-    h.update(string)
-    return h.hexdigest()
+_context = None
 
 
-def get_addresses(hostname):
+def get_context():
+    """Return the shared, long-lived getdns Context, creating it on first
+    use, so that trust anchors and DNSSEC chain data fetched for one
+    check are reused by later ones"""
+    global _context
+    if _context is None:
+        _context = getdns.Context()
+    return _context
 
-    extensions = {}
-    ctx = getdns.Context()
-    try:
-        results = ctx.address(name=hostname, extensions=extensions)
-    except (getdns.error, e):
-        print(str(e))
-        sys.exit(1)
 
+def addresses_from_results(results):
+    """Return list of (address_type, address) from address() results"""
     status = results.status
 
     address_list = []
@@ -50,6 +66,19 @@ def get_addresses(hostname):
     return address_list
 
 
+def get_addresses(hostname, ctx=None):
+
+    extensions = {}
+    ctx = ctx or get_context()
+    try:
+        results = ctx.address(name=hostname, extensions=extensions)
+    except getdns.error as e:
+        print(str(e))
+        sys.exit(1)
+
+    return addresses_from_results(results)
+
+
 def get_tlsa_rdata_set(replies, requested_usage=None):
     tlsa_rdata_set = []
     for reply in replies:
@@ -60,114 +89,231 @@ def get_tlsa_rdata_set(replies, requested_usage=None):
                 selector = rdata['selector']
                 matching_type = rdata['matching_type']
                 cadata = rdata['certificate_association_data']
-                cadata = str(cadata).encode('hex')
-                if usage == requested_usage:
+                try:
+                    cadata = cadata.tobytes()
+                except AttributeError:
+                    cadata = bytes(cadata)
+                if requested_usage is None or usage == requested_usage:
                     tlsa_rdata_set.append(
                         (usage, selector, matching_type, cadata) )
     return tlsa_rdata_set
 
 
-def get_tlsa(port, proto, hostname):
+tlsa_extensions = {
+    "dnssec_return_only_secure" : getdns.EXTENSION_TRUE,
+}
 
-    extensions = {
-        "dnssec_return_only_secure" : getdns.EXTENSION_TRUE,
-    }
-    qname = "_%d._%s.%s" % (port, proto, hostname)
-    ctx = getdns.Context()
-    results = ctx.general(name=qname,
-                          request_type=getdns.RRTYPE_TLSA,
-                          extensions=extensions)
+
+def tlsa_from_results(results):
+    """Return TLSA rdata set from general() results, or None"""
     status = results.status
 
     if status == getdns.RESPSTATUS_GOOD:
-        return get_tlsa_rdata_set(results.replies_tree, requested_usage=3)
+        return get_tlsa_rdata_set(results.replies_tree)
     else:
         print("getdns.general(): failed, return code: %d" % status)
         return None
 
 
-def verify_tlsa(cert, usage, selector, matchtype, hexdata1):
+def get_tlsa(port, proto, hostname, ctx=None):
 
-    if selector == 0:
-        certdata = cert.as_der()
-    elif selector == 1:
-        certdata = cert.get_pubkey().as_der()
-    else:
-        raise ValueError("selector type %d not recognized" % selector)
-
-    if matchtype == 0:
-        hexdata2 = hexdump(certdata)
-    elif matchtype == 1:
-        hexdata2 = compute_hash(hashlib.sha256, certdata)
-    elif matchtype == 2:
-        hexdata2 = compute_hash(hashlib.sha512, certdata)
-    else:
-        raise ValueError("matchtype %d not recognized" % matchtype)
+    qname = "_%d._%s.%s" % (port, proto, hostname)
+    ctx = ctx or get_context()
+    results = ctx.general(name=qname,
+                          request_type=getdns.RRTYPE_TLSA,
+                          extensions=tlsa_extensions)
+    return tlsa_from_results(results)
 
-    if hexdata1 == hexdata2:
-        return True
-    else:
-        return False
 
+def get_tlsa_and_addresses(port, proto, hostname, ctx=None):
+    """Look up the TLSA records and the addresses of hostname at the same
+    time, and return (tlsa_rdata_set, address_list)"""
 
-if __name__ == '__main__':
+    ctx = ctx or get_context()
+    answers = {}
+
+    def callback(cbtype, results, userarg, tid):
+        if cbtype == getdns.CALLBACK_COMPLETE:
+            answers[userarg] = results
+        else:
+            print("%s lookup failed, callback type %d" % (userarg, cbtype))
 
+    qname = "_%d._%s.%s" % (port, proto, hostname)
     try:
-        hostname, port = sys.argv[1:]
-        port = int(port)
-    except:
-        usage()
+        ctx.general(name=qname, request_type=getdns.RRTYPE_TLSA,
+                    extensions=tlsa_extensions,
+                    callback=callback, userarg="TLSA")
+        ctx.address(name=hostname, extensions={},
+                    callback=callback, userarg="address")
+    except getdns.error as e:
+        print(str(e))
+        sys.exit(1)
+    ctx.run()
 
-    tlsa_rdata_set = get_tlsa(port, "tcp", hostname)
+    tlsa_rdata_set = None
+    if "TLSA" in answers:
+        tlsa_rdata_set = tlsa_from_results(answers["TLSA"])
+    address_list = []
+    if "address" in answers:
+        address_list = addresses_from_results(answers["address"])
+    return tlsa_rdata_set, address_list
+
+
+def check_address(hostname, port, iptype, ipaddr, tlsa_rdata_set,
+                  index=None, sessions=None):
+    """Connect to one address of hostname, and match the certificate
+    chain it presents against the TLSA records (and their index, from
+    tlsa_index()), resuming a TLS session from the sessions cache if
+    given. Returns a list of output lines."""
+
+    if index is None:
+        index = dane.tlsa_index(tlsa_rdata_set)
+    need_pkix = any(rdata[0] in (0, 1) for rdata in tlsa_rdata_set)
+
+    lines = ["Connecting to %s at address %s ..." % (hostname, ipaddr)]
+    ctx = SSL.Context()
+    pkix_store = None
+    if need_pkix:
+        ctx.set_default_verify_paths()
+        pkix_store = ctx.get_cert_store()
+
+    if iptype == "IPv4":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    elif iptype == "IPv6":
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    else:
+        raise ValueError("Unknown address type: %s" % iptype)
 
-    for (iptype, ipaddr) in get_addresses(hostname):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    connection = SSL.Connection(ctx, sock=sock)
 
-        print("Connecting to %s at address %s ..." % (hostname, ipaddr))
-        ctx = SSL.Context()
+    # Kernel level send/receive timeouts (which also bound connect()),
+    # so that the socket stays in blocking mode for OpenSSL.
+    timeout = SSL.timeout(CONNECT_TIMEOUT)
+    connection.set_socket_read_timeout(timeout)
+    connection.set_socket_write_timeout(timeout)
 
-        if iptype == "IPv4":
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        elif iptype == "IPv6":
-            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    # set TLS SNI extension if available in M2Crypto on this platform
+    # Note: the official M2Crypto release does not yet (as of late 2014)
+    # have support for SNI, sigh, but patches exist.
+    try:
+        connection.set_tlsext_host_name(hostname)
+    except AttributeError:
+        pass
+
+    # Per https://tools.ietf.org/html/draft-ietf-dane-ops, for DANE-EE
+    # usage, certificate identity checks are based solely on the TLSA 
+    # record, so M2Crypto's check (against the address we connect to)
+    # is disabled; the other usages check the hostname in match_tlsa().
+    connection.postConnectionCheck = None
+    session = session_chain = None
+    if sessions:
+        # a resumed handshake sends no certificate chain, so only
+        # sessions recorded with the chain of their full handshake are
+        # offered, and that chain is checked instead
+        session, session_chain = sessions.get(hostname, port,
+                                              with_chain=True)
+        if session:
+            connection.set_session(session)
+    t0 = time.time()
+    try:
+        connection.connect((ipaddr, port))
+    except (socket.error, SSL.SSLError) as e:
+        lines.append("Connection to %s failed: %s" % (ipaddr, e))
+        connection.close()
+        ctx.close()
+        return lines
+    elapsed = time.time() - t0
+    reused = sessioncache.session_reused(connection, session)
+    if reused:
+        chain = [X509.load_cert_string(pem) for pem in session_chain]
+    else:
+        chain = connection.get_peer_cert_chain()
+    if sessions:
+        if reused:
+            pems = session_chain
         else:
-            raise (ValueError, "Unknown address type: %s" % iptype)
+            pems = [cert.as_pem() for cert in chain] if chain else None
+        sessions.record(hostname, port,
+                        sessioncache.read_session_ticket(connection), reused,
+                        elapsed, chain=pems)
+        if reused:
+            lines.append("Resumed TLS session")
+    if not chain:
+        lines.append("No certificate chain from %s" % ipaddr)
+        connection.close()
+        ctx.close()
+        return lines
 
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        connection = SSL.Connection(ctx, sock=sock)
+    # find the TLSA record entries matching the certificate chain
+    matched = dane.match_tlsa(chain, index, hostname, pkix_store)
+    for rdata in tlsa_rdata_set:
+        if rdata in matched:
+            lines.append("Matched TLSA record %s" % dane.tlsa_text(rdata))
+        else:
+            lines.append("Didn't match TLSA record %s" %
+                         dane.tlsa_text(rdata))
 
-        # set TLS SNI extension if available in M2Crypto on this platform
-        # Note: the official M2Crypto release does not yet (as of late 2014)
-        # have support for SNI, sigh, but patches exist.
-        try:
-            connection.set_tlsext_host_name(hostname)
-        except AttributeError:
-            pass
+    if not matched:
+        lines.append("No Matching TLSA record found.")
+
+    connection.close()
+    ctx.close()
+    return lines
+
+
+def check_addresses(hostname, port, address_list, tlsa_rdata_set,
+                    sessions=None):
+    """Check all addresses concurrently; returns a list of output line
+    lists, in the same order as address_list"""
 
-        # Per https://tools.ietf.org/html/draft-ietf-dane-ops, for DANE-EE
-        # usage, certificate identity checks are based solely on the TLSA 
-        # record, so we ignore name mismatch conditions in the certificate.
+    results = [None] * len(address_list)
+    index = dane.tlsa_index(tlsa_rdata_set)
+
+    def worker(position, iptype, ipaddr):
         try:
-            connection.connect((ipaddr, port))
-        except SSL.Checker.WrongHost:
-            pass
+            results[position] = check_address(hostname, port, iptype,
+                                              ipaddr, tlsa_rdata_set, index,
+                                              sessions)
+        except Exception as e:
+            results[position] = ["Connecting to %s at address %s ..." %
+                                 (hostname, ipaddr),
+                                 "Check of %s failed: %s" % (ipaddr, e)]
+
+    threads = []
+    for (position, (iptype, ipaddr)) in enumerate(address_list):
+        t = threading.Thread(target=worker, args=(position, iptype, ipaddr))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results
 
-        chain = connection.get_peer_cert_chain()
-        cert = chain[0]
-
-        # find a matching TLSA record entry for the certificate
-        tlsa_match = False
-        for (usage, selector, matchtype, hexdata) in tlsa_rdata_set:
-            if verify_tlsa(cert, usage, selector, matchtype, hexdata):
-                tlsa_match = True
-                print("Matched TLSA record %d %d %d %s" % \
-                      (usage, selector, matchtype, hexdata))
-            else:
-                print("Didn't match TLSA record %d %d %d %s"% \
-                      (usage, selector, matchtype, hexdata))
-
-        if not tlsa_match:
-            print("No Matching DANE-EE TLSA record found.")
 
-        connection.close()
-        ctx.close()
+if __name__ == '__main__':
 
+    sessions = None
+    try:
+        (options, args) = getopt.getopt(sys.argv[1:], 's:')
+        hostname, port = args
+        port = int(port)
+    except (getopt.GetoptError, ValueError):
+        usage()
+    for (opt, optval) in options:
+        if opt == '-s':
+            sessions = sessioncache.SessionCache(directory=optval)
+
+    tlsa_rdata_set, address_list = get_tlsa_and_addresses(port, "tcp",
+                                                          hostname)
+
+    M2Crypto.threading.init()
+    try:
+        for lines in check_addresses(hostname, port, address_list,
+                                     tlsa_rdata_set or [], sessions):
+            for line in lines:
+                print(line)
+        if sessions:
+            print(sessions.report())
+    finally:
+        M2Crypto.threading.cleanup()
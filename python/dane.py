@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#
+
+"""
+dane.py
+
+Match a TLS server's certificate chain against a DANE TLSA record set,
+for checkdanecert.py and get-dane-url.py. The TLSA records are given as
+(usage, selector, matching type, association data) tuples, with the
+association data as raw bytes, and indexed by (selector, matching type)
+with tlsa_index(). Each certificate's association data is computed at
+most once per such pair (CertDigests).
+
+All four usages are supported (RFC 6698, RFC 7671):
+
+    PKIX-TA (0)  a CA certificate in the chain that OpenSSL validated
+                 against the system trust store matches
+    PKIX-EE (1)  the end-entity certificate matches, and the chain
+                 validates against the system trust store
+    DANE-TA (2)  a CA certificate the server sent (or the certificate
+                 in a 2 0 0 record) matches, and the end-entity
+                 certificate verifies with it as the only trust anchor
+    DANE-EE (3)  the end-entity certificate matches
+
+All but DANE-EE also need the hostname to match the end-entity
+certificate. Chains are verified by OpenSSL, through an X509_Store: the
+system one for the PKIX usages, and one holding just the matched trust
+anchor for DANE-TA.
+
+    index = dane.tlsa_index(tlsa_rdata_set)
+    chain = connection.get_peer_cert_chain()
+    matched = dane.match_tlsa(chain, index, hostname,
+                              pkix_store=ctx.get_cert_store())
+
+Shumon Huque <shuque@gmail.com>
+"""
+
+import hashlib
+from binascii import hexlify
+from M2Crypto import SSL, X509, m2
+
+
+# TLSA matching types -> hash functions (0 is the full selected data)
+HASH_FUNCS = {
+    1: hashlib.sha256,
+    2: hashlib.sha512,
+}
+
+# let a trust anchor that is not self-signed end the chain
+PARTIAL_CHAIN = getattr(m2, 'VERIFY_PARTIAL_CHAIN', 0x80000)
+
+
+def tlsa_text(rdata):
+    """Return presentation format of a TLSA rdata tuple"""
+    usage, selector, matchtype, data = rdata
+    return "%d %d %d %s" % (usage, selector, matchtype,
+                            hexlify(data).decode())
+
+
+class CertDigests:
+    """TLSA association data of one certificate, by (selector, matching
+    type), each computed on first use and then remembered"""
+
+    def __init__(self, cert):
+        self.cert = cert
+        self.selected = {}              # selector -> DER data
+        self.digests = {}               # (selector, matchtype) -> bytes
+
+    def get(self, selector, matchtype):
+        key = (selector, matchtype)
+        if key not in self.digests:
+            if selector not in self.selected:
+                if selector == 0:
+                    self.selected[0] = self.cert.as_der()
+                elif selector == 1:
+                    self.selected[1] = self.cert.get_pubkey().as_der()
+                else:
+                    raise ValueError("selector type %d not recognized" %
+                                     selector)
+            certdata = self.selected[selector]
+            if matchtype == 0:
+                self.digests[key] = certdata
+            elif matchtype in HASH_FUNCS:
+                self.digests[key] = HASH_FUNCS[matchtype](certdata).digest()
+            else:
+                raise ValueError("matchtype %d not recognized" % matchtype)
+        return self.digests[key]
+
+
+def tlsa_index(tlsa_rdata_set):
+    """Index a TLSA rdata set as (selector, matchtype) -> association
+    data -> list of rdata. Records with unknown usage, selector or
+    matching type are unusable, and left out."""
+    index = {}
+    for rdata in tlsa_rdata_set:
+        usage, selector, matchtype, data = rdata
+        if usage in (0, 1, 2, 3) and selector in (0, 1) and \
+           (matchtype == 0 or matchtype in HASH_FUNCS):
+            index.setdefault((selector, matchtype), {}) \
+                 .setdefault(data, []).append(rdata)
+    return index
+
+
+def verify_tlsa(cert, usage, selector, matchtype, data):
+    """Return whether cert matches one TLSA record (association data as
+    raw bytes). Usage is not checked here, see match_tlsa()."""
+    return CertDigests(cert).get(selector, matchtype) == data
+
+
+def verify_chain(store, chain):
+    """Verify the end-entity certificate chain[0] with OpenSSL against
+    the trust anchors in store, with the rest of the chain the server
+    sent as untrusted intermediates. Returns the verified chain, from
+    the end-entity certificate to the trust anchor, or None."""
+    untrusted = X509.X509_Stack()
+    for cert in chain[1:]:
+        untrusted.push(cert)
+    store_ctx = X509.X509_Store_Context()
+    store_ctx.init(store, chain[0], untrusted)
+    if store_ctx.verify_cert() != 1:
+        return None
+    return list(store_ctx.get1_chain())
+
+
+def ta_store(ta):
+    """Return an X509_Store with ta as the only trust anchor"""
+    store = X509.X509_Store()
+    store.set_flags(PARTIAL_CHAIN)
+    store.add_x509(ta)
+    return store
+
+
+def name_check(cert, hostname):
+    """Return whether cert matches hostname"""
+    try:
+        return bool(SSL.Checker.Checker(host=hostname)(cert))
+    except SSL.Checker.SSLVerificationError:
+        return False
+
+
+def match_tlsa(chain, index, hostname, pkix_store=None):
+    """Return the list of TLSA rdata in index (from tlsa_index()) matched
+    by the certificate chain a server sent, end-entity certificate
+    first. The PKIX usages are only matched if pkix_store, the system
+    trust store, is given."""
+    chain = list(chain)
+    usages = set(rdata[0] for records in index.values()
+                 for rdatas in records.values() for rdata in rdatas)
+    names_ok = name_check(chain[0], hostname) if usages - set([3]) \
+               else False
+
+    pkix_chain = None
+    if pkix_store is not None and usages & set([0, 1]) and names_ok:
+        pkix_chain = verify_chain(pkix_store, chain)
+
+    matched = []
+
+    def add(rdata):
+        if rdata not in matched:
+            matched.append(rdata)
+
+    def ta_verifies(ta):
+        return names_ok and verify_chain(ta_store(ta), chain) is not None
+
+    ee = CertDigests(chain[0])
+    peer_cas = [CertDigests(cert) for cert in chain[1:]]
+    pkix_cas = [CertDigests(cert) for cert in (pkix_chain or [])[1:]]
+    for (key, records) in index.items():
+        for rdata in records.get(ee.get(*key), []):
+            if rdata[0] == 3 or (rdata[0] == 1 and pkix_chain):
+                add(rdata)
+        if 0 in usages:
+            for digests in pkix_cas:
+                for rdata in records.get(digests.get(*key), []):
+                    if rdata[0] == 0:
+                        add(rdata)
+        if 2 in usages:
+            for digests in peer_cas:
+                for rdata in records.get(digests.get(*key), []):
+                    if rdata[0] == 2 and rdata not in matched and \
+                       ta_verifies(digests.cert):
+                        add(rdata)
+
+    # DANE-TA certificates given in full, which the server need not send
+    for (data, rdatas) in index.get((0, 0), {}).items():
+        if data == ee.get(0, 0):
+            continue                    # a trust anchor is a CA
+        for rdata in rdatas:
+            if rdata[0] != 2 or rdata in matched:
+                continue
+            try:
+                ta = X509.load_cert_der_string(data)
+            except X509.X509Error:
+                continue
+            if ta_verifies(ta):
+                add(rdata)
+    return matched
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+#
+
+"""
+dns_standin.py
+
+A small stand-in DNS server for offline testing and benchmarking. It
+listens on the loopback address over UDP, TCP and (optionally) TLS, and
+answers every query itself, as a recursive resolver would:
+
+    - A and AAAA queries get a synthesized address (192.0.2.0/24 and
+      2001:db8::/32) derived from the query name
+    - names ending in "nxdomain." get NXDOMAIN
+    - all other types get NODATA
+    - negative answers carry a SOA record in the authority section
+
+TCP and TLS connections may carry any number of pipelined queries. An
+artificial per-query delay can be added to simulate upstream latency.
+If TLS is wanted and no certificate is given, a throwaway self-signed
+one is generated with the openssl command.
+
+Usage: dns_standin.py [-a addr] [-p port] [-t tls_port] [-d delay_ms]
+                      [-c certfile -k keyfile]
+
+Shumon Huque <shuque@gmail.com>
+"""
+
+import os, os.path, sys, getopt, struct, socket, ssl, threading, time
+import subprocess, tempfile, zlib
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+import dns.message, dns.rrset, dns.rdatatype, dns.rcode, dns.flags
+
+
+TTL = 300
+SOA = "standin. hostmaster.standin. 1 3600 600 86400 60"
+
+
+def make_response(wire):
+    """Return wire format response to given wire format query, or None
+    if the query could not be parsed"""
+    try:
+        query = dns.message.from_wire(wire)
+    except Exception:
+        return None
+    response = dns.message.make_response(query)
+    response.flags |= dns.flags.RA
+    if not query.question:
+        response.set_rcode(dns.rcode.FORMERR)
+        return response.to_wire()
+    q = query.question[0]
+    qname = q.name.to_text()
+    n = zlib.crc32(qname.lower().encode()) & 0xffffffff
+    if qname.lower().endswith("nxdomain."):
+        response.set_rcode(dns.rcode.NXDOMAIN)
+    elif q.rdtype == dns.rdatatype.A:
+        response.answer.append(dns.rrset.from_text(
+            q.name, TTL, 'IN', 'A', "192.0.2.%d" % (n % 254 + 1)))
+    elif q.rdtype == dns.rdatatype.AAAA:
+        response.answer.append(dns.rrset.from_text(
+            q.name, TTL, 'IN', 'AAAA', "2001:db8::%x" % (n & 0xffff)))
+    if not response.answer:
+        response.authority.append(dns.rrset.from_text(
+            'standin.', TTL, 'IN', 'SOA', SOA))
+    return response.to_wire()
+
+
+def recv_exactly(sock, n):
+    """Read exactly n octets from a stream socket; None on EOF"""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        count = sock.recv_into(view[got:], n - got)
+        if count == 0:
+            return None
+        got += count
+    return bytes(buf)
+
+
+class UDPHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        data, sock = self.request
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        response = make_response(data)
+        if response is not None:
+            sock.sendto(response, self.client_address)
+
+
+class StreamHandler(socketserver.BaseRequestHandler):
+    """Answer length prefixed queries until the client closes"""
+
+    def handle(self):
+        sock = self.request
+        lock = threading.Lock()
+        while True:
+            try:
+                prefix = recv_exactly(sock, 2)
+                if prefix is None:
+                    break
+                wire = recv_exactly(sock, struct.unpack('!H', prefix)[0])
+                if wire is None:
+                    break
+            except socket.error:           # includes failed TLS handshakes
+                break
+            if self.server.delay:
+                # answer out of order, like a real recursive resolver
+                threading.Thread(target=self.answer,
+                                 args=(sock, lock, wire)).start()
+            else:
+                self.answer(sock, lock, wire)
+
+    def answer(self, sock, lock, wire):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        response = make_response(wire)
+        if response is None:
+            return
+        with lock:
+            try:
+                sock.sendall(struct.pack('!H', len(response)) + response)
+            except (socket.error, ValueError):
+                pass
+
+
+class UDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    daemon_threads = True
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class TLSServer(TCPServer):
+
+    sslcontext = None
+
+    def get_request(self):
+        sock, addr = self.socket.accept()
+        sock = self.sslcontext.wrap_socket(sock, server_side=True,
+                                           do_handshake_on_connect=False)
+        return sock, addr
+
+
+def make_self_signed_cert(directory):
+    """Generate a self-signed certificate and key for localhost using the
+    openssl command, returning (certfile, keyfile)"""
+    certfile = os.path.join(directory, "standin.crt")
+    keyfile = os.path.join(directory, "standin.key")
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(["openssl", "req", "-x509", "-nodes",
+                               "-newkey", "rsa:2048", "-days", "1",
+                               "-subj", "/CN=localhost",
+                               "-keyout", keyfile, "-out", certfile],
+                              stdout=devnull, stderr=devnull)
+    return certfile, keyfile
+
+
+class StandinServer:
+    """UDP, TCP and optionally TLS stand-in DNS server, run in background
+    threads. A port of 0 picks a free port; the chosen ports are in the
+    port and tls_port attributes after start()."""
+
+    def __init__(self, address='127.0.0.1', port=0, tls_port=None,
+                 certfile=None, keyfile=None, delay=0.0):
+        self.address = address
+        self.port = port
+        self.tls_port = tls_port
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.delay = delay
+        self.servers = []
+        self.tmpdir = None
+
+    def start(self):
+        udp = UDPServer((self.address, self.port), UDPHandler)
+        self.port = udp.server_address[1]
+        tcp = TCPServer((self.address, self.port), StreamHandler)
+        self.servers = [udp, tcp]
+        if self.tls_port is not None:
+            if not self.certfile:
+                self.tmpdir = tempfile.mkdtemp()
+                self.certfile, self.keyfile = \
+                    make_self_signed_cert(self.tmpdir)
+            tls = TLSServer((self.address, self.tls_port), StreamHandler)
+            tls.sslcontext = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            tls.sslcontext.load_cert_chain(self.certfile, self.keyfile)
+            self.tls_port = tls.server_address[1]
+            self.servers.append(tls)
+        for server in self.servers:
+            server.delay = self.delay
+            t = threading.Thread(target=server.serve_forever)
+            t.daemon = True
+            t.start()
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        if self.tmpdir:
+            for f in os.listdir(self.tmpdir):
+                os.remove(os.path.join(self.tmpdir, f))
+            os.rmdir(self.tmpdir)
+        return
+
+
+def usage():
+    print("""\
+Usage: {0} [-a addr] [-p port] [-t tls_port] [-d delay_ms]
+                      [-c certfile -k keyfile]
+
+    -a addr: address to listen on (default 127.0.0.1)
+    -p port: UDP and TCP port (default 5353)
+    -t tls_port: also listen for DNS over TLS on this port
+    -d delay_ms: delay each answer by this many milliseconds
+    -c certfile, -k keyfile: TLS certificate and key (default: generate
+       a self-signed certificate)
+""".format(os.path.basename(sys.argv[0])))
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    try:
+        (options, args) = getopt.getopt(sys.argv[1:], 'a:p:t:d:c:k:')
+    except getopt.GetoptError:
+        usage()
+    if args:
+        usage()
+
+    server = StandinServer(port=5353)
+    for (opt, optval) in options:
+        if opt == '-a':
+            server.address = optval
+        elif opt == '-p':
+            server.port = int(optval)
+        elif opt == '-t':
+            server.tls_port = int(optval)
+        elif opt == '-d':
+            server.delay = int(optval) / 1000.0
+        elif opt == '-c':
+            server.certfile = optval
+        elif opt == '-k':
+            server.keyfile = optval
+
+    server.start()
+    print("Listening on %s port %d (UDP, TCP)" % (server.address, server.port))
+    if server.tls_port is not None:
+        print("Listening on %s port %d (TLS)" % (server.address,
+                                                 server.tls_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
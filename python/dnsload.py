@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+#
+
+"""
+dnsload.py
+
+A dnsperf-style DNS load generator. The query set is read and encoded
+to wire format once, up front (with tfodnsclient.make_query); sending a
+query then only patches its 2-byte message ID in place. Queries are
+sent over UDP or TCP (pipelined, length prefixed) from a non-blocking
+selectors event loop, either as fast as the limit on queries in flight
+allows, or at a target rate. At the end it reports the achieved qps,
+the lost (timed out) queries, latency percentiles and response codes.
+
+The query file has one "qname qtype" per line, as for dnsperf; the
+queries are sent in order, over and over, until the run time or the
+query count is reached. With -S, a stand-in server (dns_standin.py)
+is started on the loopback address and used as the target, to check
+the generator itself:
+
+$ dnsload.py -S -d queries.txt -l 5 -Q 2000
+$ dnsload.py -s 127.0.0.1 -p 5353 -m tcp -c 4 -q 200 -d queries.txt
+
+Shumon Huque <shuque@gmail.com>
+"""
+
+import os.path, sys, getopt, time, socket, selectors, struct, errno, math
+from collections import deque, OrderedDict
+import tfodnsclient
+
+
+class Opts:
+    server = '127.0.0.1'
+    port = 53
+    transport = 'udp'
+    datafile = None
+    duration = 10.0                     # seconds to send for
+    count = None                        # or stop after this many queries
+    qps = 0                             # target rate, 0 for no limit
+    sockets = 1                         # UDP sockets or TCP connections
+    outstanding = 100                   # max queries in flight
+    timeout = 2.0                       # seconds until a query is lost
+    standin = False
+
+
+RCODE_NAMES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN',
+               4: 'NOTIMP', 5: 'REFUSED'}
+
+
+class Histogram:
+    """Latency histogram with logarithmic buckets (as in getdns_query.py),
+    so that memory use does not grow with the number of queries and
+    percentiles have bounded relative error"""
+
+    base = 1.02                     # bucket width: 2% of the latency
+
+    def __init__(self):
+        self.buckets = dict()       # bucket number -> count
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        usec = max(seconds * 1000000, 1.0)
+        bucket = int(math.log(usec) / math.log(self.base))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Return upper bound of the bucket holding the p'th percentile"""
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.base ** (bucket + 1) / 1000000, self.max)
+        return self.max
+
+
+def usage():
+    print("""\
+Usage: {0} [Options] -d <queryfile>
+
+    -d file: query file, "qname qtype" per line ("-" for stdin)
+    -s server: server address (default {1})
+    -p port: server port (default {2})
+    -m udp|tcp: transport (default udp)
+    -l seconds: run time (default {3:g})
+    -n count: stop after sending count queries
+    -Q qps: target query rate (default: as fast as possible)
+    -c sockets: number of UDP sockets or TCP connections (default 1)
+    -q outstanding: max number of queries in flight (default {4})
+    -t timeout: seconds after which a query counts as lost (default {5:g})
+    -S: start a local stand-in server (dns_standin.py) and use it
+""".format(os.path.basename(sys.argv[0]), Opts.server, Opts.port,
+           Opts.duration, Opts.outstanding, Opts.timeout))
+    sys.exit(1)
+
+
+def read_queryfile(f):
+    """Generate (qname, qtype) tuples from a dnsperf style query file"""
+    for line in f:
+        fields = line.split()
+        if fields and not fields[0].startswith('#'):
+            yield (fields[0], fields[1] if fields[1:] else 'A')
+
+
+def encode_queries(queries):
+    """Encode queries once into length prefixed wire format buffers;
+    UDP sends them without the 2-byte prefix"""
+    return [bytearray(tfodnsclient.make_query(qname, qtype, 0))
+            for (qname, qtype) in queries]
+
+
+class Channel:
+    """A UDP socket or TCP connection to the server. TCP channels keep
+    a send buffer, and a preallocated receive buffer that responses are
+    read into with recv_into() and framed in place."""
+
+    def __init__(self, transport, saddr, family):
+        self.transport = transport
+        self.saddr = saddr
+        self.family = family
+        self.outbuf = bytearray()
+        self.inbuf = bytearray(2 * (tfodnsclient.MAXMSGSIZE + 2))
+        self.inview = memoryview(self.inbuf)
+        self.inlen = 0
+        self.connect()
+
+    def connect(self):
+        if self.transport == 'udp':
+            self.sock = socket.socket(self.family, socket.SOCK_DGRAM)
+            self.sock.connect(self.saddr)
+            self.sock.setblocking(False)
+        else:
+            self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.setblocking(False)
+            err = self.sock.connect_ex(self.saddr)
+            if err not in (0, errno.EINPROGRESS):
+                raise socket.error(err, os.strerror(err))
+            self.outbuf = bytearray()
+            self.inlen = 0
+
+
+class LoadGenerator:
+    """The event loop and its statistics"""
+
+    def __init__(self, wires):
+        self.wires = wires
+        self.sel = selectors.DefaultSelector()
+        self.channels = []
+        self.free_ids = deque(range(65536))
+        self.quarantine = deque()           # (release time, msgid)
+        self.outstanding = OrderedDict()    # msgid -> (send time, channel)
+        self.rbuf = bytearray(tfodnsclient.MAXMSGSIZE)
+        self.rview = memoryview(self.rbuf)
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.unexpected = 0                 # late or unknown responses
+        self.latencies = Histogram()
+        self.rcodes = {}
+        self.next_query = 0
+        self.next_channel = 0
+
+    def open_channels(self):
+        family, socktype, proto, cano, saddr = socket.getaddrinfo(
+            Opts.server, Opts.port, socket.AF_UNSPEC,
+            socket.SOCK_DGRAM)[0]
+        for i in range(Opts.sockets):
+            channel = Channel(Opts.transport, saddr, family)
+            self.sel.register(channel.sock, selectors.EVENT_READ, channel)
+            self.channels.append(channel)
+
+    def send_one(self, now):
+        """Patch the ID of the next pre-encoded query, and send it"""
+        wire = self.wires[self.next_query]
+        self.next_query = (self.next_query + 1) % len(self.wires)
+        channel = self.channels[self.next_channel]
+        self.next_channel = (self.next_channel + 1) % len(self.channels)
+        msgid = self.free_ids.popleft()
+        struct.pack_into('!H', wire, 2, msgid)
+        if channel.transport == 'udp':
+            try:
+                channel.sock.send(memoryview(wire)[2:])
+            except socket.error:
+                pass                        # counted as lost on timeout
+        else:
+            if not channel.outbuf:
+                self.sel.modify(channel.sock, selectors.EVENT_READ |
+                                selectors.EVENT_WRITE, channel)
+            channel.outbuf += wire
+        self.outstanding[msgid] = (now, channel)
+        self.sent += 1
+
+    def flush(self, channel):
+        """Write out as much of a TCP channel's send buffer as we can"""
+        try:
+            n = channel.sock.send(channel.outbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            self.reconnect(channel)
+            return
+        del channel.outbuf[:n]
+        if not channel.outbuf:
+            self.sel.modify(channel.sock, selectors.EVENT_READ, channel)
+
+    def reconnect(self, channel):
+        """Replace a TCP connection the server closed; its queries in
+        flight will time out"""
+        self.sel.unregister(channel.sock)
+        channel.sock.close()
+        channel.connect()
+        self.sel.register(channel.sock, selectors.EVENT_READ, channel)
+
+    def response(self, wire, now):
+        """Account for a response in wire format"""
+        if len(wire) < 12:
+            self.unexpected += 1
+            return
+        msgid = tfodnsclient.message_id(wire)
+        if msgid not in self.outstanding:
+            self.unexpected += 1
+            return
+        sent_at, channel = self.outstanding.pop(msgid)
+        self.free_ids.append(msgid)
+        self.received += 1
+        self.latencies.add(now - sent_at)
+        rcode = wire[3] & 0x0f
+        self.rcodes[rcode] = self.rcodes.get(rcode, 0) + 1
+
+    def read(self, channel, now):
+        if channel.transport == 'udp':
+            while True:
+                try:
+                    n = channel.sock.recv_into(self.rbuf)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except socket.error:
+                    return                  # e.g. ICMP port unreachable
+                self.response(self.rview[:n], now)
+        try:
+            n = channel.sock.recv_into(channel.inview[channel.inlen:])
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            n = 0
+        if n == 0:
+            self.reconnect(channel)
+            return
+        channel.inlen += n
+        pos = 0
+        while channel.inlen - pos >= 2:
+            msglen, = struct.unpack_from('!H', channel.inbuf, pos)
+            if channel.inlen - pos - 2 < msglen:
+                break
+            self.response(channel.inview[pos+2:pos+2+msglen], now)
+            pos += 2 + msglen
+        if pos:
+            remaining = channel.inlen - pos
+            channel.inview[:remaining] = channel.inview[pos:channel.inlen]
+            channel.inlen = remaining
+
+    def expire(self, now):
+        """Count queries in flight for longer than the timeout as lost.
+        Their IDs are quarantined for another timeout before reuse, so
+        that a late response is not taken for a newer query's."""
+        while self.quarantine and \
+              now - self.quarantine[0][0] >= Opts.timeout:
+            self.free_ids.append(self.quarantine.popleft()[1])
+        while self.outstanding:
+            msgid, (sent_at, channel) = next(iter(self.outstanding.items()))
+            if now - sent_at < Opts.timeout:
+                return
+            del self.outstanding[msgid]
+            self.quarantine.append((now, msgid))
+            self.lost += 1
+
+    def run(self):
+        """Send queries until the run time or count is reached, then
+        wait for the last responses; returns the duration of the send
+        phase and the total elapsed time"""
+        self.open_channels()
+        interval = 1.0 / Opts.qps if Opts.qps else 0.0
+        start = time.time()
+        end = start + Opts.duration
+        next_send = start
+        send_end = None
+        while True:
+            now = time.time()
+            sending = now < end and \
+                (Opts.count is None or self.sent < Opts.count)
+            while sending and len(self.outstanding) < Opts.outstanding \
+                  and self.free_ids and next_send <= now:
+                self.send_one(now)
+                if Opts.count is not None and self.sent >= Opts.count:
+                    sending = False
+                if interval:
+                    next_send += interval
+                    if next_send < now - 1.0:
+                        next_send = now     # don't burst to catch up
+            if not sending and send_end is None:
+                send_end = now
+            if not sending and not self.outstanding:
+                break
+            self.expire(now)
+            if self.outstanding:
+                wait = next(iter(self.outstanding.values()))[0] + \
+                    Opts.timeout - now
+            else:
+                wait = 0.1
+            if sending and not self.free_ids and self.quarantine:
+                wait = min(wait, self.quarantine[0][0] + Opts.timeout - now)
+            elif sending and len(self.outstanding) < Opts.outstanding:
+                wait = min(wait, next_send - now)
+            if sending:
+                wait = min(wait, end - now)
+            for (key, events) in self.sel.select(max(0.0, wait)):
+                channel = key.data
+                now = time.time()
+                if events & selectors.EVENT_READ:
+                    self.read(channel, now)
+                if events & selectors.EVENT_WRITE and channel.outbuf:
+                    self.flush(channel)
+        elapsed = time.time() - start
+        for channel in self.channels:
+            channel.sock.close()
+        self.sel.close()
+        return send_end - start, elapsed
+
+
+def format_ms(seconds):
+    return "{:.1f}ms".format(seconds * 1000)
+
+
+def print_stats(gen, send_time, elapsed):
+    """Print the statistics; rates are over the send phase, not the
+    wait for the last responses after it"""
+    send_time = send_time or elapsed
+    print("\nElapsed time: {:.3f}s (sending {:.3f}s)".format(elapsed,
+                                                            send_time))
+    print("Sent: {} ({:.1f} qps), answered: {}, lost: {} ({:.2f}%), "
+          "unexpected: {}".format(
+              gen.sent, gen.sent / send_time, gen.received, gen.lost,
+              100.0 * gen.lost / gen.sent if gen.sent else 0.0,
+              gen.unexpected))
+    if not gen.received:
+        return
+    latencies = gen.latencies
+    print("Queries: {} ({:.1f} qps)".format(gen.received,
+                                            gen.received / send_time))
+    print("Latency: p50 {} p90 {} p99 {} max {}".format(
+        format_ms(latencies.percentile(50)),
+        format_ms(latencies.percentile(90)),
+        format_ms(latencies.percentile(99)), format_ms(latencies.max)))
+    print("By rcode:")
+    for rcode, count in sorted(gen.rcodes.items()):
+        print("  {:<20} {:>8}".format(RCODE_NAMES.get(rcode, str(rcode)),
+                                      count))
+
+
+if __name__ == '__main__':
+
+    try:
+        (options, args) = getopt.getopt(sys.argv[1:], 'd:s:p:m:l:n:Q:c:q:t:S')
+    except getopt.GetoptError:
+        usage()
+    if args:
+        usage()
+
+    for (opt, optval) in options:
+        if opt == '-d':
+            Opts.datafile = optval
+        elif opt == '-s':
+            Opts.server = optval
+        elif opt == '-p':
+            Opts.port = int(optval)
+        elif opt == '-m':
+            if optval not in ('udp', 'tcp'):
+                usage()
+            Opts.transport = optval
+        elif opt == '-l':
+            Opts.duration = float(optval)
+        elif opt == '-n':
+            Opts.count = int(optval)
+        elif opt == '-Q':
+            Opts.qps = float(optval)
+        elif opt == '-c':
+            Opts.sockets = int(optval)
+        elif opt == '-q':
+            Opts.outstanding = min(int(optval), 65536)
+        elif opt == '-t':
+            Opts.timeout = float(optval)
+        elif opt == '-S':
+            Opts.standin = True
+
+    if not Opts.datafile:
+        usage()
+    f = sys.stdin if Opts.datafile == '-' else open(Opts.datafile)
+    wires = encode_queries(read_queryfile(f))
+    if not wires:
+        print("No queries in %s" % Opts.datafile)
+        sys.exit(1)
+
+    server = None
+    if Opts.standin:
+        import dns_standin
+        server = dns_standin.StandinServer()
+        server.start()
+        Opts.server, Opts.port = server.address, server.port
+
+    gen = LoadGenerator(wires)
+    try:
+        send_time, elapsed = gen.run()
+    finally:
+        if server:
+            server.stop()
+    print_stats(gen, send_time, elapsed)
@@ -1,19 +1,21 @@
 #!/usr/bin/env python
 #
 # Get a TLS certificate from a HTTP server and verify it with
-# DANE/DNSSEC. Only supports TLSA usage type 3 (DANE-EE).
-# 
+# DANE/DNSSEC. All TLSA usages are supported, see dane.py.
+#
+# The TLSA and address lookups are done concurrently, on a single
+# long-lived getdns Context that can be shared with other code (pass
+# one in, or use get_context()).
+#
+# With -s <dir>, the TLS session is cached in dir and resumed by later
+# runs (see sessioncache.py).
+#
 
-import sys, socket, hashlib
+import sys, socket, getopt, time
 from M2Crypto import SSL, X509
 import getdns
-
-
-def compute_hash(func, string):
-    """compute hash of string using given hash function"""
-    h = func()
-    h.update(string)
-    return h.hexdigest()
+import dane
+import sessioncache
 
 
 def get_tlsa_rdata_set(replies):
@@ -26,20 +28,27 @@ def get_tlsa_rdata_set(replies):
                 selector = rdata['selector']
                 matching_type = rdata['matching_type']
                 cadata = rdata['certificate_association_data']
-                cadata = str(cadata).encode('hex')
+                cadata = str(cadata)
                 tlsa_rdata_set.append(
                     (usage, selector, matching_type, cadata) )
     return tlsa_rdata_set
 
 
-def get_tlsa(port, proto, hostname):
+_context = None
 
-    qname = "_%d._%s.%s" % (port, proto, hostname)
-    ctx = getdns.Context()
-    extensions = { "dnssec_return_only_secure": getdns.GETDNS_EXTENSION_TRUE }
-    results = ctx.general(name=qname,
-                          request_type=getdns.GETDNS_RRTYPE_TLSA,
-                          extensions=extensions)
+
+def get_context():
+    """Return the shared getdns Context, creating it on first use"""
+    global _context
+    if _context is None:
+        _context = getdns.Context()
+    return _context
+
+
+tlsa_extensions = { "dnssec_return_only_secure": getdns.GETDNS_EXTENSION_TRUE }
+
+
+def tlsa_from_results(results):
     status = results['status']
 
     if status == getdns.GETDNS_RESPSTATUS_GOOD:
@@ -49,57 +58,124 @@ def get_tlsa(port, proto, hostname):
         return None
 
 
-def verify_tlsa(cert, usage, selector, matchtype, hexdata1):
+def get_tlsa(port, proto, hostname, ctx=None):
+
+    qname = "_%d._%s.%s" % (port, proto, hostname)
+    ctx = ctx or get_context()
+    results = ctx.general(name=qname,
+                          request_type=getdns.GETDNS_RRTYPE_TLSA,
+                          extensions=tlsa_extensions)
+    return tlsa_from_results(results)
+
 
-    if usage != 3:
-        print "Only TLSA usage type 3 is currently supported"
-        return
+def get_tlsa_and_addresses(port, proto, hostname, ctx=None):
+    """Look up the TLSA records and the addresses of hostname at the same
+    time; returns (tlsa_rdata_set, list of (address_type, address))"""
 
-    if selector == 0:
-        certdata = cert.as_der()
-    elif selector == 1:
-        certdata = cert.get_pubkey().as_der()
-    else:
-        raise ValueError("selector type %d not recognized" % selector)
-
-    if matchtype == 0:
-        hexdata2 = hexdump(certdata)
-    elif matchtype == 1:
-        hexdata2 = compute_hash(hashlib.sha256, certdata)
-    elif matchtype == 2:
-        hexdata2 = compute_hash(hashlib.sha512, certdata)
-    else:
-        raise ValueError("matchtype %d not recognized" % matchtype)
+    ctx = ctx or get_context()
+    answers = {}
 
-    if hexdata1 == hexdata2:
-        return True
-    else:
-        return False
+    def callback(cbtype, results, userarg, tid):
+        if cbtype == getdns.GETDNS_CALLBACK_COMPLETE:
+            answers[userarg] = results
+        else:
+            print "getdns: %s lookup failed, callback type %d" % \
+                (userarg, cbtype)
+
+    qname = "_%d._%s.%s" % (port, proto, hostname)
+    ctx.general(name=qname, request_type=getdns.GETDNS_RRTYPE_TLSA,
+                extensions=tlsa_extensions, callback=callback, userarg="TLSA")
+    ctx.address(name=hostname, extensions={}, callback=callback,
+                userarg="address")
+    ctx.run()
+
+    tlsa_rdata_set = None
+    if "TLSA" in answers:
+        tlsa_rdata_set = tlsa_from_results(answers["TLSA"])
+    address_list = []
+    if "address" in answers:
+        results = answers["address"]
+        if results['status'] == getdns.GETDNS_RESPSTATUS_GOOD:
+            for addr in results['just_address_answers']:
+                address_list.append((addr['address_type'],
+                                     addr['address_data']))
+        else:
+            print "getdns: failed looking up address, code: %d" % \
+                results['status']
+    return tlsa_rdata_set, address_list
 
 
 if __name__ == '__main__':
 
-    hostname, port = sys.argv[1:]
+    (options, args) = getopt.getopt(sys.argv[1:], 's:')
+    sessions = None
+    for (opt, optval) in options:
+        if opt == '-s':
+            sessions = sessioncache.SessionCache(directory=optval)
+    hostname, port = args
     port = int(port)
-    tlsa_rdata_set = get_tlsa(port, "tcp", hostname)
+    tlsa_rdata_set, address_list = get_tlsa_and_addresses(port, "tcp",
+                                                          hostname)
+    if not address_list:
+        print "ERROR: no addresses found for %s" % hostname
+        sys.exit(1)
+    iptype, ipaddr = address_list[0]
+
+    tlsa_rdata_set = tlsa_rdata_set or []
+    need_pkix = any(rdata[0] in (0, 1) for rdata in tlsa_rdata_set)
 
     ctx = SSL.Context()
+    pkix_store = None
+    if need_pkix:
+        ctx.set_default_verify_paths()
+        pkix_store = ctx.get_cert_store()
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if iptype == "IPv6":
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
     connection = SSL.Connection(ctx, sock=sock)
-    connection.connect((hostname, port))
-
-    cert = connection.get_peer_cert_chain()[0]
-
-    tlsa_match = False
-    for (usage, selector, matchtype, hexdata) in tlsa_rdata_set:
-        if verify_tlsa(cert, usage, selector, matchtype, hexdata):
-            tlsa_match = True
-            break
-
-    if not tlsa_match:
+    try:
+        connection.set_tlsext_host_name(hostname)
+    except AttributeError:
+        pass
+    # DANE-EE: identity is checked with the TLSA record alone; the
+    # other usages check the hostname in match_tlsa()
+    connection.postConnectionCheck = None
+    # a resumed handshake sends no certificate chain: only sessions
+    # recorded with the chain of their full handshake are offered
+    session = session_chain = None
+    if sessions:
+        session, session_chain = sessions.get(hostname, port,
+                                              with_chain=True)
+        if session:
+            connection.set_session(session)
+    t0 = time.time()
+    connection.connect((ipaddr, port))
+    elapsed = time.time() - t0
+    reused = sessioncache.session_reused(connection, session)
+    if reused:
+        chain = [X509.load_cert_string(pem) for pem in session_chain]
+    else:
+        chain = connection.get_peer_cert_chain()
+    if sessions:
+        if reused:
+            pems = session_chain
+        else:
+            pems = [cert.as_pem() for cert in chain] if chain else None
+        sessions.record(hostname, port,
+                        sessioncache.read_session_ticket(connection), reused,
+                        elapsed, chain=pems)
+    if not chain:
+        print "ERROR: no certificate chain from %s" % ipaddr
+        sys.exit(1)
+
+    matched = dane.match_tlsa(chain, dane.tlsa_index(tlsa_rdata_set),
+                              hostname, pkix_store)
+
+    if not matched:
         print "ERROR: no matching TLSA records found"
     else:
         CMD = "GET / HTTP/1.1\r\nHost:%s\r\nConnection: close\r\n\r\n" % \
@@ -113,3 +189,6 @@ if __name__ == '__main__':
     ctx.close()
     sock.close()
 
+    if sessions:
+        print sessions.report()
+
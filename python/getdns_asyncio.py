@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+
+"""
+getdns_asyncio.py
+
+asyncio adapter for a getdns Context: awaitable address(), general(),
+service() and hostname() lookups, sent concurrently, for coroutines on
+an asyncio event loop.
+
+    import asyncio, getdns, getdns_asyncio
+
+    async def main():
+        actx = getdns_asyncio.AsyncContext()
+        results = await asyncio.gather(actx.address("www.example.com"),
+                                       actx.address("www.example.net"))
+        await actx.close()
+
+The getdns python bindings do not expose the Context's file descriptor
+or a non-blocking "process events" call, only the blocking run(), which
+also holds the GIL. So the Context is driven from the event loop
+itself: each lookup is submitted with a callback when it is made, and
+the first one schedules a run() of the Context with call_soon(). By
+then the other coroutines that were ready have submitted their lookups
+too, and run() sends them all at once, resolving each future from the
+callback as its answer arrives. Other asyncio I/O waits while run()
+is busy, as it would with any blocking call.
+
+Shumon Huque <shuque@gmail.com>
+"""
+
+import asyncio, itertools
+import getdns
+
+
+class QueryError(Exception):
+    """A getdns lookup was cancelled or failed without a response"""
+
+    def __init__(self, message, cbtype):
+        Exception.__init__(self, message)
+        self.cbtype = cbtype
+
+
+class AsyncContext:
+    """Wrap a getdns.Context (a new one by default) for use from asyncio.
+    The Context must not be used directly by other code afterwards."""
+
+    def __init__(self, ctx=None):
+        self.ctx = ctx or getdns.Context()
+        self.futures = dict()              # userarg -> future
+        self.ids = itertools.count()
+        self.scheduled = False             # a run() is due on the loop
+
+    async def close(self):
+        """Wait for the outstanding lookups to complete"""
+        while self.futures:
+            await asyncio.wait(list(self.futures.values()))
+
+    async def general(self, name, request_type, extensions=None):
+        return await self._lookup('general', (name, request_type),
+                                  extensions)
+
+    async def address(self, name, extensions=None):
+        return await self._lookup('address', (name,), extensions)
+
+    async def service(self, name, extensions=None):
+        return await self._lookup('service', (name,), extensions)
+
+    async def hostname(self, address, extensions=None):
+        return await self._lookup('hostname', (address,), extensions)
+
+    def _lookup(self, method, args, extensions):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        userarg = str(next(self.ids))
+        try:
+            getattr(self.ctx, method)(*args, extensions=extensions or {},
+                                      callback=self._callback,
+                                      userarg=userarg)
+        except getdns.error as e:
+            future.set_exception(e)
+            return future
+        self.futures[userarg] = future
+        if not self.scheduled:
+            self.scheduled = True
+            loop.call_soon(self._run)
+        return future
+
+    def _run(self):
+        """Run the Context until the lookups submitted so far are done"""
+        self.scheduled = False
+        self.ctx.run()
+
+    def _callback(self, cbtype, res, userarg, tid):
+        future = self.futures.pop(userarg)
+        if future.done():
+            return                      # cancelled by the caller
+        if cbtype == getdns.CALLBACK_COMPLETE:
+            future.set_result(res)
+        elif cbtype == getdns.CALLBACK_TIMEOUT:
+            future.set_exception(asyncio.TimeoutError())
+        elif cbtype == getdns.CALLBACK_CANCEL:
+            future.set_exception(QueryError("query cancelled", cbtype))
+        else:
+            future.set_exception(QueryError("query failed", cbtype))
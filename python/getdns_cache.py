@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+
+"""
+getdns_cache.py
+
+A TTL-aware in-process response cache in front of a getdns Context.
+
+CachingContext wraps a getdns.Context and answers repeated general(),
+address(), service() and hostname() calls for the same name, type and
+extensions from memory until the smallest TTL in the answer expires.
+NXDOMAIN and NODATA responses are cached too, for the negative TTL
+derived from the SOA record in the authority section (RFC 2308). The
+cache holds at most maxsize entries and evicts the least recently used.
+
+    ctx = getdns_cache.CachingContext(getdns.Context(), maxsize=10000)
+    results = ctx.general(name="www.example.com",
+                          request_type=getdns.RRTYPE_A)
+    print(ctx.cache.hits, ctx.cache.misses)
+
+Attributes that are not cache related (timeout, upstreams, etc) are
+passed through to the wrapped Context.
+
+Shumon Huque <shuque@gmail.com>
+"""
+
+import time, json
+from collections import OrderedDict
+import getdns
+
+
+NEGATIVE_TTL = 300                     # when there is no SOA to go by
+
+
+def min_ttl(results, negative_ttl=NEGATIVE_TTL):
+    """Return the number of seconds the results may be cached for, or
+    None if they should not be cached at all"""
+    if results.status not in (getdns.RESPSTATUS_GOOD,
+                              getdns.RESPSTATUS_NO_NAME):
+        return None
+    ttls = []
+    negative = []
+    for reply in results.replies_tree:
+        for rr in reply.get('answer', []):
+            ttls.append(rr['ttl'])
+        for rr in reply.get('authority', []):
+            if rr['type'] == getdns.RRTYPE_SOA:
+                negative.append(min(rr['ttl'], rr['rdata']['minimum']))
+    if ttls:
+        return min(ttls)
+    if negative:
+        return min(negative)
+    return negative_ttl
+
+
+class ResponseCache:
+    """LRU cache of getdns results with per entry expiry times"""
+
+    def __init__(self, maxsize=10000, negative_ttl=NEGATIVE_TTL):
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()    # key -> (expire time, results)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(method, name, rrtype=None, extensions=None):
+        """Return cache key for a query. Extension values may be
+        unhashable (e.g. the add_opt_parameters dict), so the extensions
+        are keyed by a canonical serialisation."""
+        if extensions:
+            extensions = json.dumps(extensions, sort_keys=True, default=repr)
+        else:
+            extensions = ""
+        return (method, name.lower(), rrtype, extensions)
+
+    def get(self, key):
+        """Return cached results for key, or None"""
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] <= time.time():
+            self.misses += 1
+            return None
+        self.entries[key] = entry       # now most recently used
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, results):
+        """Store results for key, if they are cacheable"""
+        ttl = min_ttl(results, self.negative_ttl)
+        if not ttl:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + ttl, results)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return (float(self.hits) / lookups) if lookups else 0.0
+
+
+class CachingContext(object):
+    """getdns Context wrapper that consults a ResponseCache first.
+
+    Asynchronous calls (with a callback) are cached as well: on a miss
+    the query is submitted with a callback that stores the result before
+    calling the caller's callback. On a hit the caller's callback is
+    invoked before the call returns, with a transaction id of None, and
+    None is returned."""
+
+    def __init__(self, ctx, maxsize=10000, negative_ttl=NEGATIVE_TTL):
+        self.__dict__['ctx'] = ctx
+        self.__dict__['cache'] = ResponseCache(maxsize, negative_ttl)
+
+    def __getattr__(self, attr):
+        return getattr(self.ctx, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.ctx, attr, value)
+
+    def _query(self, key, method, args, kwargs):
+        results = self.cache.get(key)
+        callback = kwargs.get('callback')
+        if callback is None:
+            if results is None:
+                results = method(*args, **kwargs)
+                self.cache.put(key, results)
+            return results
+        if results is not None:
+            callback(getdns.CALLBACK_COMPLETE, results,
+                     kwargs.get('userarg'), None)
+            return None
+
+        def store(cbtype, res, userarg, tid):
+            if cbtype == getdns.CALLBACK_COMPLETE:
+                self.cache.put(key, res)
+            callback(cbtype, res, userarg, tid)
+
+        kwargs['callback'] = store
+        return method(*args, **kwargs)
+
+    def general(self, name, request_type, extensions=None, **kwargs):
+        kwargs['extensions'] = extensions or {}
+        key = self.cache.key('general', name, request_type, extensions)
+        return self._query(key, self.ctx.general, (name, request_type),
+                           kwargs)
+
+    def address(self, name, extensions=None, **kwargs):
+        kwargs['extensions'] = extensions or {}
+        key = self.cache.key('address', name, None, extensions)
+        return self._query(key, self.ctx.address, (name,), kwargs)
+
+    def service(self, name, extensions=None, **kwargs):
+        kwargs['extensions'] = extensions or {}
+        key = self.cache.key('service', name, None, extensions)
+        return self._query(key, self.ctx.service, (name,), kwargs)
+
+    def hostname(self, address, extensions=None, **kwargs):
+        kwargs['extensions'] = extensions or {}
+        key = self.cache.key('hostname', address['address_data'], None,
+                             extensions)
+        return self._query(key, self.ctx.hostname, (address,), kwargs)
@@ -7,17 +7,21 @@
 # getdns library source distribution.
 #
 # TODO
-# - keeping TCP connections open for TLS and TCP transports?
-# - non-pretty print option: display presentation format response RRs
 # - Support setting EDNS options
 # - Support setting of qclass
 # - Use: getdns.get_errorstr_by_id()?
 # - Support getdns_context_set_dnssec_trust_anchors()
-# - Add better timing information
 #
 
-import sys, getopt, os.path, time, socket, pprint, base64
+import sys, getopt, os.path, time, socket, pprint, base64, json, math
+import subprocess, threading
 import getdns
+import getdns_cache
+
+try:
+    import dns.rdata, dns.rdataclass, dns.rdatatype
+except ImportError:
+    dns = None
 
 
 def usage():
@@ -33,11 +37,15 @@ Options:
             a port (@), TLS port (#), and TLS hostname (~), e.g.
             @127.0.0.1
             @10.8.9.17#853~rdns.example.com
+            May be given more than once: queries then go to the
+            healthy server with the lowest smoothed RTT.
 
     -a Perform asynchronous resolution (default = synchronous)
     -r Set recursing resolution type
     -s Set stub resolution type (default = recursing)
     -q Quiet mode - don't print response
+    -z Print answer RRs in presentation format, one per line (needs dnspython)
+    -j Print one JSON object per query, summary to stderr (needs dnspython)
 
     -A address lookup (<type> is ignored)
     -H hostname lookup. (<name> must be an IP address; <type> is ignored)
@@ -48,7 +56,12 @@ Options:
 
     -B Batch mode. Schedule all messages before processing responses.
     -F <filename> read the queries from the specified file
-    -I Interactive mode (> 1 queries on same context)
+    -W <window> Max number of async queries in flight (default 100).
+       Duplicate async queries are merged into an outstanding one.
+    -N <nprocs> Shard the -F queries across nprocs worker processes
+    -C <size> Cache up to size responses in-process, honoring TTLs
+    -I Interactive mode (> 1 queries on same context). Reads
+       "<qname> [<qtype>]" lines from stdin until EOF or "quit"
     -b <bufsize> Set edns0 max_udp_payload size
     -c Send Client Subnet privacy request
     -D Set edns0 do bit
@@ -63,6 +76,10 @@ Options:
     -O Set transport to TCP only keep connections open
     -L Set transport to TLS only keep connections open
     -E Set transport to TLS with TCP fallback only keep connections open
+       (-O/-L/-E pipeline async queries on the open connections, default
+       idle timeout 10s)
+    -x Estimate upstream connection reuse of -O/-L/-E, from the timing
+       of requests in call reporting and the idle timeout
     -R Set transport to STARTTLS with TCP fallback only keep connections open
     -u Set transport to UDP with TCP fallback
     -U Set transport to UDP only
@@ -82,10 +99,11 @@ Options:
 
 class Options:
     """Options data structure"""
-    server          = None
-    async           = False
+    async_mode      = False
     batch           = False
     quiet           = False
+    presentation    = False
+    json            = False
     lookup_address  = False
     lookup_hostname = False
     lookup_srv      = False
@@ -95,7 +113,108 @@ class Options:
     interactive     = False
     root_ta         = False
     keep_open       = False
-
+    conn_stats      = False         # report connection reuse (-x)
+    nworkers        = 1
+    shard           = None          # (index, count) in a worker process,
+                                    # which reads its queries from stdin
+    transport       = None          # name of configured transport list
+    cachesize       = 0
+    idle_timeout    = None
+
+
+class Batch:
+    """State of the bounded-concurrency asynchronous batch engine"""
+    window          = 100           # max number of queries in flight
+    queries         = None          # iterator of (qname, qtype) to submit
+    inflight        = 0
+    started         = dict()        # transaction id -> submission time
+    keys            = dict()        # transaction id -> (key, qname, qtype)
+    waiting         = dict()        # key -> [(time, qname, qtype), ...]
+    duplicates      = 0             # queries in waiting lists
+    submitting      = None          # (key, qname, qtype) being submitted
+
+
+class Histogram:
+    """Latency histogram with logarithmic buckets, so that percentiles
+    have bounded relative error and histograms from different worker
+    processes can be merged by adding bucket counts."""
+
+    base = 1.02                     # bucket width: 2% of the latency
+
+    def __init__(self):
+        self.buckets = dict()       # bucket number -> count
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        usec = max(seconds * 1000000, 1.0)
+        bucket = int(math.log(usec) / math.log(self.base))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Return upper bound of the bucket holding the p'th percentile"""
+        rank = math.ceil(self.count * p / 100.0)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.base ** (bucket + 1) / 1000000, self.max)
+        return self.max
+
+    def as_dict(self):
+        return dict(buckets=self.buckets, max=self.max)
+
+    def merge(self, d):
+        for bucket, count in d['buckets'].items():
+            bucket = int(bucket)
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+            self.count += count
+        self.max = max(self.max, d['max'])
+
+
+class Upstreams:
+    """Upstream recursive servers given with @server, with the smoothed
+    RTT and failure rate measured for each, used to order them"""
+    servers         = []            # address dicts, in current order
+    srtt            = dict()        # address -> smoothed RTT (seconds)
+    failrate        = dict()        # address -> smoothed failure rate
+    counts          = dict()        # address -> [queries, failures, rtt sum]
+    completions     = 0
+
+
+class Stats:
+    """Query statistics; merged in the parent process when using -N"""
+    latency         = Histogram()
+    status          = dict()        # status name -> Histogram
+    transport       = dict()        # transport name -> Histogram
+    cache_hits      = 0
+    cache_misses    = 0
+    coalesced       = 0             # duplicates merged into outstanding
+    connections     = dict()        # upstream -> [connections, queries]
+    last_active     = dict()        # upstream -> last completion time
+
+
+STATS_MARKER = '#getdns_query-stats: '
+
+INTERACTIVE_IDLE_TIMEOUT = 300000       # milliseconds
+KEEP_OPEN_IDLE_TIMEOUT = 10000          # milliseconds
+
+RTT_ALPHA = 0.125                       # smoothing factors, as TCP's SRTT
+FAIL_ALPHA = 0.1
+UNHEALTHY_FAILRATE = 0.5
+RERANK_INTERVAL = 16                    # completed queries
+UNMEASURED_SRTT = 0.5                   # seconds, for untried upstreams
+
+STATUS_NAMES = dict((getattr(getdns, x), x[11:]) for x in dir(getdns)
+                    if x.startswith('RESPSTATUS_'))
+
+DNSSEC_NAMES = dict((getattr(getdns, x), x[7:]) for x in dir(getdns)
+                    if x.startswith('DNSSEC_'))
+
+TRANSPORT_NAMES = dict((getattr(getdns, x), x[10:]) for x in dir(getdns)
+                       if x.startswith('TRANSPORT_'))
 
 Exts = dict()
 
@@ -109,8 +228,7 @@ def parse_args(arglist):
             usage()
 
         elif arg.startswith('@'):
-            Options.server = arg[1:]
-            set_recursive_server(ctx, Options.server)
+            add_recursive_server(ctx, arg[1:])
             
         elif arg == '+dnssec_return_status':
             Exts['dnssec_return_status'] = getdns.EXTENSION_TRUE
@@ -128,7 +246,7 @@ def parse_args(arglist):
             Exts['return_call_debugging'] = getdns.EXTENSION_TRUE
 
         elif arg == '-a':
-            Options.async = True
+            Options.async_mode = True
 
         elif arg == '-A':
             Options.lookup_address = True
@@ -143,6 +261,9 @@ def parse_args(arglist):
         elif arg == '-c':
             ctx.edns_client_subnet_private = 1
 
+        elif arg == '-C':
+            Options.cachesize = int(arglist.pop(0))
+
         elif arg == '-D':
             ctx.edns_do_bit = 1
 
@@ -150,7 +271,8 @@ def parse_args(arglist):
             ctx.edns_do_bit = 0
 
         elif arg == '-e':
-            ctx.idle_timeout = int(arglist.pop(0))
+            Options.idle_timeout = int(arglist.pop(0))
+            ctx.idle_timeout = Options.idle_timeout
 
         elif arg == '-F':
             Options.filename = arglist.pop(0)
@@ -167,6 +289,13 @@ def parse_args(arglist):
         elif arg == '-I':
             Options.interactive = True
 
+        elif arg == '-N':
+            Options.nworkers = int(arglist.pop(0))
+
+        elif arg == '--shard':
+            index, count = arglist.pop(0).split('/')
+            Options.shard = (int(index), int(count))
+
         elif arg == '-k':
             Options.root_ta = True
 
@@ -182,6 +311,18 @@ def parse_args(arglist):
         elif arg == '-q':
             Options.quiet = True
 
+        elif arg == '-z':
+            if dns is None:
+                print("ERROR: -z requires the dnspython module\n")
+                usage()
+            Options.presentation = True
+
+        elif arg == '-j':
+            if dns is None:
+                print("ERROR: -j requires the dnspython module\n")
+                usage()
+            Options.json = True
+
         elif arg == '-r':
             ctx.resolution_type = getdns.RESOLUTION_RECURSING
 
@@ -215,6 +356,15 @@ def parse_args(arglist):
         elif arg == '-U':
             ctx.dns_transport_list = [ getdns.TRANSPORT_UDP ]
 
+        elif arg == '-x':
+            Options.conn_stats = True
+
+        elif arg == '-W':
+            Batch.window = int(arglist.pop(0))
+            if Batch.window < 1:
+                print("ERROR: window must be at least 1\n")
+                usage()
+
         elif arg.startswith('-'):
             print("ERROR: Invalid option: {}\n".format(arg))
             usage()
@@ -227,7 +377,16 @@ def parse_args(arglist):
             arglist.insert(0, arg)
             break
 
-    if Options.api_info or Options.root_ta or Options.filename:
+    if Options.nworkers > 1 and not Options.filename:
+        print("ERROR: -N needs -F\n")
+        usage()
+
+    if Options.conn_stats and not Options.keep_open:
+        print("ERROR: -x needs -O, -L or -E\n")
+        usage()
+
+    if Options.api_info or Options.root_ta or Options.filename or \
+       Options.interactive:
         # ignore unneeded qname and qtype if specified
         return (None, None)
 
@@ -244,8 +403,8 @@ def parse_args(arglist):
     return (qname, qtype)
 
 
-def set_recursive_server(ctx, server):
-    """set upstream recursive server in the getdns context.
+def add_recursive_server(ctx, server):
+    """add upstream recursive server to the getdns context.
     server is an IP address, optionally followed by a prefixed
     port (@), TLS port (#), and TLS hostname (~).
     """
@@ -264,12 +423,92 @@ def set_recursive_server(ctx, server):
     components = sorted(position, key=lambda k: position[k])
     zipped = (list(zip(components, values)))
     d = get_address_dict(zipped[0][1])
+    # same textual form as the addresses in call reporting
+    af = socket.AF_INET6 if d['address_type'] == 'IPv6' else socket.AF_INET
+    d['address_data'] = socket.inet_ntop(af, socket.inet_pton(
+        af, d['address_data']))
     for x, y in zipped[1:]:
         if x == 'port' or x == 'tls_port':
             d[x] = int(y)
         else:
             d[x] = y
-    ctx.upstream_recursive_servers = [d]
+    Upstreams.servers.append(d)
+    ctx.upstream_recursive_servers = Upstreams.servers
+    return
+
+
+def rank_upstreams(ctx):
+    """Order the upstreams healthy first, then by smoothed RTT; untried
+    upstreams count as UNMEASURED_SRTT, so they are tried once the
+    measured ones do worse than that. In stub mode getdns
+    sends queries to the first upstream and only falls back to the next
+    on failure, so the order decides where queries go. The failure rate
+    of unhealthy upstreams decays a little on each call, so that they
+    are retried eventually."""
+    for address, rate in Upstreams.failrate.items():
+        if rate >= UNHEALTHY_FAILRATE:
+            Upstreams.failrate[address] = rate * 0.9
+    def sort_key(d):
+        address = d['address_data']
+        return (Upstreams.failrate.get(address, 0.0) >= UNHEALTHY_FAILRATE,
+                Upstreams.srtt.get(address, UNMEASURED_SRTT))
+    order = sorted(Upstreams.servers, key=sort_key)
+    # setting the upstreams makes getdns drop its upstream state (and
+    # open connections), so only do it when the order has changed
+    if [upstream_key(d) for d in order] != \
+       [upstream_key(d) for d in Upstreams.servers]:
+        Upstreams.servers = order
+        ctx.upstream_recursive_servers = order
+    return
+
+
+def upstream_key(d):
+    """Return (address, port, TLS port) of an upstream address dict"""
+    return (d['address_data'], d.get('port'), d.get('tls_port'))
+
+
+def charge_upstream(address, failed, rtt):
+    """Update the RTT and failure statistics of an upstream with one
+    request to it; a failed request is charged rtt as a penalty"""
+    counts = Upstreams.counts.setdefault(address, [0, 0, 0.0])
+    counts[0] += 1
+    rate = Upstreams.failrate.get(address, 0.0)
+    Upstreams.failrate[address] = rate + FAIL_ALPHA * (failed - rate)
+    if failed:
+        counts[1] += 1
+    else:
+        counts[2] += rtt
+    srtt = Upstreams.srtt.get(address)
+    if srtt is None:
+        Upstreams.srtt[address] = rtt
+    else:
+        Upstreams.srtt[address] = srtt + RTT_ALPHA * (rtt - srtt)
+    return
+
+
+def record_upstreams(status, res, latency):
+    """Update RTT and failure statistics of the upstreams a query was
+    sent to (from call reporting), and reorder the upstreams every
+    RERANK_INTERVAL queries. Call reporting has an entry for each
+    network request of the query (address lookups make one per address
+    type), with the upstream that request ended up at. A request failed
+    if no reply of its type came back, and is charged the query's
+    latency. Without results (a CALLBACK_TIMEOUT) the upstream tried
+    first is charged."""
+    if res is None:
+        charge_upstream(Upstreams.servers[0]['address_data'], True, latency)
+    else:
+        answered = set()
+        if status != getdns.RESPSTATUS_ALL_TIMEOUT:
+            for reply in res.replies_tree:
+                answered.add(reply.get('question', {}).get('qtype'))
+        for report in call_reports(res):
+            failed = report.get('query_type') not in answered
+            rtt = latency if failed else report.get('run_time/ms', 0) / 1000.0
+            charge_upstream(report_address(report), failed, rtt)
+    Upstreams.completions += 1
+    if Upstreams.completions % RERANK_INTERVAL == 0:
+        rank_upstreams(ctx)
     return
 
 
@@ -335,26 +574,355 @@ def print_root_trust_anchor():
     return
 
 
+def transport_name(transport_list):
+    """Return printable name of a list of getdns transport codes"""
+    return '+'.join(TRANSPORT_NAMES.get(x, str(x)) for x in transport_list)
+
+
+def call_reports(res):
+    """Return the call reporting list of a result (needs the
+    +return_call_debugging extension), or an empty list."""
+    if res is None:
+        return []
+    for attr in ('call_reporting', 'call_debugging'):
+        reports = getattr(res, attr, None)
+        if reports:
+            return reports
+    return []
+
+
+def report_address(report):
+    """Return the upstream address string of a call reporting entry"""
+    query_to = report.get('query_to', {})
+    address = query_to.get('address_data', '?')
+    if not isinstance(address, str):
+        try:
+            address = address.tobytes()
+        except AttributeError:
+            pass
+        af = socket.AF_INET6 if len(address) == 16 else socket.AF_INET
+        address = socket.inet_ntop(af, address)
+    return address
+
+
+def upstream_name(report):
+    """Return "<transport> <address>" for a call reporting entry"""
+    return "{} {}".format(TRANSPORT_NAMES.get(report.get('transport'), '?'),
+                          report_address(report))
+
+
+def record_connection(report, now):
+    """Count a network request of a keep-open transport, and estimate
+    whether it needed a new connection. Call reporting does not say
+    which connection a request used, but gives the transport and the
+    upstream the request went over, and its run time, so when it was
+    sent. getdns keeps a connection per upstream and transport open until
+    it has been idle for idle_timeout, and pipelines new requests on it,
+    so a request sent more than idle_timeout after the last completion
+    on its upstream and transport is taken to need a new connection, and
+    any other request to reuse one. Connections the upstream closed
+    early are not seen. UDP requests (fallback) use no connection."""
+    if report.get('transport') == getdns.TRANSPORT_UDP:
+        return
+    name = upstream_name(report)
+    sent = now - report.get('run_time/ms', 0) / 1000.0
+    last = Stats.last_active.get(name)
+    if name not in Stats.connections:
+        Stats.connections[name] = [0, 0]
+    if last is None or sent - last > Options.idle_timeout / 1000.0:
+        Stats.connections[name][0] += 1
+    Stats.connections[name][1] += 1
+    Stats.last_active[name] = max(now, last or now)
+    return
+
+
+def record_query(status, latency, res=None, upstream=True):
+    """Record the outcome (a response status code or a name) and latency
+    of a query. The transport is taken from call reporting when present,
+    otherwise from the configured transport list. upstream is False for
+    results that did not come from an upstream just now (cache hits and
+    coalesced duplicates), which only count towards the latency
+    statistics."""
+    name = STATUS_NAMES.get(status, str(status))
+    reports = call_reports(res)
+    if reports:
+        transport = TRANSPORT_NAMES.get(reports[-1].get('transport'), '?')
+        if upstream and Options.keep_open and Options.conn_stats:
+            now = time.time()
+            for report in reports:
+                record_connection(report, now)
+    else:
+        transport = Options.transport
+    if upstream and len(Upstreams.servers) > 1 and \
+       (res is not None or status == 'TIMEOUT'):
+        record_upstreams(status, res, latency)
+    Stats.latency.add(latency)
+    for table, key in ((Stats.status, name), (Stats.transport, transport)):
+        if key not in table:
+            table[key] = Histogram()
+        table[key].add(latency)
+    return
+
+
+def stats_dict():
+    """Return statistics as a dictionary, for passing between processes"""
+    return dict(cache=(Stats.cache_hits, Stats.cache_misses),
+                coalesced=Stats.coalesced,
+                connections=Stats.connections,
+                upstreams=dict((k, v + [Upstreams.srtt.get(k)])
+                               for k, v in Upstreams.counts.items()),
+                latency=Stats.latency.as_dict(),
+                status=dict((k, v.as_dict()) for k, v in Stats.status.items()),
+                transport=dict((k, v.as_dict())
+                               for k, v in Stats.transport.items()))
+
+
+def merge_stats(d):
+    """Merge a dictionary produced by stats_dict() into Stats"""
+    Stats.cache_hits += d['cache'][0]
+    Stats.cache_misses += d['cache'][1]
+    Stats.coalesced += d['coalesced']
+    for address, (queries, failures, rtts, srtt) in d['upstreams'].items():
+        counts = Upstreams.counts.setdefault(address, [0, 0, 0.0])
+        if srtt is not None:
+            # weighted by number of queries, across the workers
+            old = Upstreams.srtt.get(address)
+            Upstreams.srtt[address] = srtt if old is None else \
+                (old * counts[0] + srtt * queries) / (counts[0] + queries)
+        counts[0] += queries
+        counts[1] += failures
+        counts[2] += rtts
+    for name, (conns, queries) in d['connections'].items():
+        if name not in Stats.connections:
+            Stats.connections[name] = [0, 0]
+        Stats.connections[name][0] += conns
+        Stats.connections[name][1] += queries
+    Stats.latency.merge(d['latency'])
+    for table, key in ((Stats.status, 'status'),
+                       (Stats.transport, 'transport')):
+        for name, hist in d[key].items():
+            if name not in table:
+                table[name] = Histogram()
+            table[name].merge(hist)
+    return
+
+
+def format_ms(seconds):
+    return "{:.1f}ms".format(seconds * 1000)
+
+
+def print_stats(elapsed):
+    """Print summary statistics for the run: overall latency percentiles
+    and qps, followed by a breakdown by response status and transport"""
+    print("\nElapsed time: {:.3f}s".format(elapsed))
+    hist = Stats.latency
+    if not hist.count:
+        return
+    print("Queries: {} ({:.1f} qps)".format(hist.count, hist.count / elapsed))
+    print("Latency: p50 {} p90 {} p99 {} max {}".format(
+        format_ms(hist.percentile(50)), format_ms(hist.percentile(90)),
+        format_ms(hist.percentile(99)), format_ms(hist.max)))
+    for title, table in (("By status:", Stats.status),
+                         ("By transport:", Stats.transport)):
+        print(title)
+        for name, h in sorted(table.items()):
+            print("  {:<20} {:>8} p50 {} p99 {} max {}".format(
+                name, h.count, format_ms(h.percentile(50)),
+                format_ms(h.percentile(99)), format_ms(h.max)))
+    if Stats.coalesced:
+        print("Coalesced: {} duplicate queries ({:.1f}% dedup ratio)".format(
+            Stats.coalesced, 100.0 * Stats.coalesced / hist.count))
+    lookups = Stats.cache_hits + Stats.cache_misses
+    if lookups:
+        print("Cache: {} hits, {} misses ({:.1f}% hit ratio)".format(
+            Stats.cache_hits, Stats.cache_misses,
+            100.0 * Stats.cache_hits / lookups))
+    if Stats.connections:
+        print("Upstream connections (estimated from request times and "
+              "the {}ms idle timeout):".format(Options.idle_timeout))
+        for name, (conns, queries) in sorted(Stats.connections.items()):
+            print("  {:<30} ~{} connections, {} requests, ~{} reused".format(
+                name, conns, queries, queries - conns))
+    if Upstreams.counts:
+        print("Upstreams:")
+        for address, (queries, failures, rtts) in \
+                sorted(Upstreams.counts.items()):
+            answered = queries - failures
+            print("  {:<30} {} queries, {} failed ({:.1f}%), mean rtt {}, "
+                  "srtt {}".format(
+                      address, queries, failures, 100.0 * failures / queries,
+                      format_ms(rtts / answered) if answered else '-',
+                      format_ms(Upstreams.srtt[address])
+                      if address in Upstreams.srtt else '-'))
+    return
+
+
+def run_workers(argv, nworkers):
+    """Run this script again as nworkers processes, each with its own
+    Context built from the same arguments. The input file is read here,
+    once, and its queries are dealt out to the workers' stdin in turn,
+    so each worker gets its own shard. Worker output is copied to stdout
+    line by line as it arrives, and the statistics each worker reports
+    at the end are merged."""
+    workers = []
+    for index in range(nworkers):
+        cmd = [sys.executable, sys.argv[0],
+               '--shard', '{}/{}'.format(index, nworkers)] + argv
+        workers.append(subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        universal_newlines=True))
+    lock = threading.Lock()
+    stats = []
+
+    def feed():
+        alive = list(workers)
+        for n, (qname, qtype) in enumerate(read_queries(Options.filename)):
+            proc = workers[n % nworkers]
+            if proc not in alive:
+                continue                # exited early; counted below
+            try:
+                proc.stdin.write("{} {}\n".format(qname, qtype))
+            except (IOError, OSError):
+                alive.remove(proc)
+        for proc in workers:
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def copy(proc):
+        for line in proc.stdout:
+            if line.startswith(STATS_MARKER):
+                stats.append(json.loads(line[len(STATS_MARKER):]))
+            else:
+                with lock:
+                    sys.stdout.write(line)
+
+    threads = [threading.Thread(target=feed)] + \
+              [threading.Thread(target=copy, args=(proc,))
+               for proc in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for proc in workers:
+        proc.wait()
+        if proc.returncode != 0:
+            sys.stderr.write("ERROR: worker exited with status {}\n".format(
+                proc.returncode))
+    for d in stats:
+        merge_stats(d)
+    return
+
+
 def callback(cbtype, res, userarg, tid):
-    """Callback function for asynchronous mode queries"""
+    """Callback function for asynchronous mode queries. tid is None for
+    responses answered from the cache (-C) during submission. Duplicates
+    of the query that were merged into it get the same result."""
+    now = time.time()
+    t0 = Batch.started.pop(tid, None)
+    if tid is None:
+        key, qname, qtype = Batch.submitting
+    else:
+        key, qname, qtype = Batch.keys.pop(tid)
+    handle_result(cbtype, res, userarg, now - t0 if t0 is not None else 0.0,
+                  qname, qtype, upstream=tid is not None)
+    for t0, qname, qtype in Batch.waiting.pop(key, []):
+        Batch.duplicates -= 1
+        handle_result(cbtype, res, userarg, now - t0, qname, qtype,
+                      upstream=False)
+    if tid is not None:
+        Batch.inflight -= 1
+        fill_window(ctx)
+
+
+def handle_result(cbtype, res, userarg, latency, qname, qtype,
+                  upstream=True):
+    """Record and print the result of an asynchronous query"""
     if cbtype == getdns.CALLBACK_COMPLETE:
         status = res.status
-        if status == getdns.RESPSTATUS_GOOD:
+        record_query(status, latency, res, upstream)
+        if Options.json:
+            print_json(qname, qtype, status, latency, res)
+        elif status == getdns.RESPSTATUS_GOOD:
             print_response(res, userarg)
         elif status == getdns.RESPSTATUS_NO_SECURE_ANSWERS:
             print("{}: No DNSSEC secured responses found".format(userarg))
         else:
             print("{}: getdns returned error: {}".format(userarg, status))
     elif cbtype == getdns.CALLBACK_CANCEL:
-        print('Callback cancelled')
+        record_query('CANCEL', latency)
+        if Options.json:
+            print_json(qname, qtype, 'CANCEL', latency)
+        else:
+            print('Callback cancelled')
     elif cbtype == getdns.CALLBACK_TIMEOUT:
-        print('Callback: Query timed out')
+        record_query('TIMEOUT', latency)
+        if Options.json:
+            print_json(qname, qtype, 'TIMEOUT', latency)
+        else:
+            print('Callback: Query timed out')
     else:
-        print("Callback: Unknown error: {}".format(cbtype))
+        record_query('ERROR', latency)
+        if Options.json:
+            print_json(qname, qtype, 'ERROR', latency)
+        else:
+            print("Callback: Unknown error: {}".format(cbtype))
+    return
+
+
+def read_queries(filename):
+    """Generate (qname, qtype) tuples from a query file ("-" for stdin),
+    one per line"""
+    f = sys.stdin if filename == '-' else open(filename)
+    try:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            qname = fields[0]
+            qtype = fields[1] if len(fields) > 1 else 'A'
+            yield (qname, qtype)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def fill_window(ctx):
+    """Submit pending queries until the async window is full. Called
+    once to prime the window and then from the callback as each query
+    completes, so only Batch.window queries are ever outstanding. A query
+    identical to an outstanding one is not sent, but waits for the
+    outstanding one's result; it still takes up a window slot, so that
+    no more than Batch.window queries are read ahead of their answers."""
+    while Batch.queries is not None and \
+          Batch.inflight + Batch.duplicates < Batch.window:
+        try:
+            qname, qtype = next(Batch.queries)
+        except StopIteration:
+            Batch.queries = None
+            break
+        t0 = time.time()
+        key = (qname.lower(), rrtypecode(qtype))
+        if key in Batch.waiting:
+            Batch.waiting[key].append((t0, qname, qtype))
+            Batch.duplicates += 1
+            Stats.coalesced += 1
+            continue
+        # the callback runs during submission on a cache hit (-C)
+        Batch.submitting = (key, qname, qtype)
+        tid = do_query_async(ctx, qname, qtype)
+        if tid is not None:
+            Batch.started[tid] = t0
+            Batch.keys[tid] = Batch.submitting
+            Batch.waiting[key] = []
+            Batch.inflight += 1
+    return
 
 
 def do_query_async(ctx, qname, qtype):
-    """Perform queries asynchronously"""
+    """Perform queries asynchronously. Returns the transaction id, or
+    None if nothing is outstanding (submission failed or cache hit)."""
     qtype = rrtypecode(qtype)
     tid = None
     userarg = "{} {}".format(qname, qtype)
@@ -376,13 +944,19 @@ def do_query_async(ctx, qname, qtype):
             tid = ctx.general(qname, request_type=qtype, extensions=Exts,
                               callback=callback, userarg=userarg)
     except getdns.error as e:
-        print("ERROR: query submission failed: {}: {}".format(userarg,str(e)))
+        if Options.json:
+            print_json(qname, qtype, 'ERROR', 0.0, error=str(e))
+        else:
+            print("ERROR: query submission failed: {}: {}".format(userarg,
+                                                                  str(e)))
     return tid
 
 
 def do_query(ctx, qname, qtype):
     """Perform queries (synchronously)"""
     qtype = rrtypecode(qtype)
+    hits = ctx.cache.hits if Options.cachesize else 0
+    t0 = time.time()
     try:
         if Options.lookup_address:
             res = ctx.address(qname, extensions=Exts)
@@ -393,11 +967,19 @@ def do_query(ctx, qname, qtype):
         elif Options.lookup_general:
             res = ctx.general(qname, request_type=qtype, extensions=Exts)
     except getdns.error as e:
-        print(str(e))
+        if Options.json:
+            print_json(qname, qtype, 'ERROR', time.time() - t0, error=str(e))
+        else:
+            print(str(e))
         sys.exit(1)
 
     status = res.status
-    if status == getdns.RESPSTATUS_GOOD:
+    latency = time.time() - t0
+    cached = Options.cachesize and ctx.cache.hits > hits
+    record_query(status, latency, res, upstream=not cached)
+    if Options.json:
+        print_json(qname, qtype, status, latency, res)
+    elif status == getdns.RESPSTATUS_GOOD:
         print_response(res, "{} {}".format(qname, qtype))
     elif status == getdns.RESPSTATUS_NO_NAME:
         print("Error: %s, %s: no such name" % (qname, qtype))
@@ -410,8 +992,106 @@ def do_query(ctx, qname, qtype):
     return
 
 
+def rr_to_text(rr):
+    """Return presentation format string for an RR dictionary"""
+    rdata_raw = rr['rdata']['rdata_raw']
+    try:
+        rdata_raw = rdata_raw.tobytes()
+    except AttributeError:
+        pass
+    rdata = dns.rdata.from_wire(rr['class'], rr['type'],
+                                rdata_raw, 0, len(rdata_raw))
+    return "{} {} {} {} {}".format(rr['name'], rr['ttl'],
+                                   dns.rdataclass.to_text(rr['class']),
+                                   dns.rdatatype.to_text(rr['type']),
+                                   rdata.to_text())
+
+
+def print_response_compact(res, query_info):
+    """Print answer RRs in presentation format, one line per RR, with
+    other details as ';' comments. Output is assembled and written in
+    one call rather than via pprint."""
+    lines = [";; {}: RESPONSE_STATUS: {}".format(query_info, res.status)]
+    for rnum, reply in enumerate(res.replies_tree):
+        if 'dnssec_return_status' in Exts:
+            lines.append(";; Reply {}: dnssec_return_status={}".format(
+                rnum, reply['dnssec_status']))
+        if not Options.quiet:
+            lines.extend(rr_to_text(rr) for rr in reply['answer'])
+    if not Options.quiet:
+        if 'dnssec_return_validation_chain' in Exts:
+            lines.append(";; VALIDATION CHAIN:")
+            lines.extend(rr_to_text(rr) for rr in res.validation_chain)
+    sys.stdout.write('\n'.join(lines) + '\n')
+    return
+
+
+def interactive(ctx):
+    """Read-eval loop: resolve "<qname> [<qtype>]" lines from stdin on
+    the same Context, printing the time taken by each query"""
+    prompt = sys.stdin.isatty()
+    while True:
+        if prompt:
+            sys.stdout.write("> ")
+            sys.stdout.flush()
+        line = sys.stdin.readline()
+        if not line:
+            break
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        if fields[0] in ('quit', 'exit'):
+            break
+        qname = fields[0]
+        qtype = fields[1] if len(fields) > 1 else 'A'
+        t0 = time.time()
+        try:
+            if Options.async_mode:
+                Batch.queries = iter([(qname, qtype)])
+                fill_window(ctx)
+                ctx.run()
+            else:
+                do_query(ctx, qname, qtype)
+        except SystemExit:
+            # rrtypecode() and do_query() exit on errors; keep going
+            continue
+        if not Options.json:
+            print("Query time: {}".format(format_ms(time.time() - t0)))
+        sys.stdout.flush()
+    return
+
+
+def print_json(qname, qtype, status, latency, res=None, error=None):
+    """Write a JSON object with the outcome of a query on a line of its
+    own: query name and type, status, latency, answer RRs in presentation
+    format, and the DNSSEC status of each reply (if requested with
+    +dnssec_return_status). A query that could not be submitted has
+    status ERROR and the error message in error."""
+    answers = []
+    dnssec = None
+    if res is not None:
+        for reply in res.replies_tree:
+            answers.extend(rr_to_text(rr) for rr in reply['answer'])
+            if 'dnssec_status' in reply:
+                dnssec = dnssec or []
+                dnssec.append(DNSSEC_NAMES.get(reply['dnssec_status'],
+                                               reply['dnssec_status']))
+    d = dict(qname=qname,
+             qtype=dns.rdatatype.to_text(rrtypecode(qtype)),
+             status=STATUS_NAMES.get(status, str(status)),
+             latency_ms=round(latency * 1000, 3),
+             answers=answers,
+             dnssec=dnssec)
+    if error is not None:
+        d['error'] = error
+    sys.stdout.write(json.dumps(d, sort_keys=True) + '\n')
+    return
+
+
 def print_response(res, query_info):
     """Print response details"""
+    if Options.presentation:
+        return print_response_compact(res, query_info)
     print("{}: RESPONSE_STATUS: {}".format(query_info, res.status))
     for rnum, reply in enumerate(res.replies_tree):
         if 'dnssec_return_status' in Exts:
@@ -428,7 +1108,28 @@ def print_response(res, query_info):
 if __name__ == '__main__':
 
     ctx = getdns.Context()
-    qname, qtype = parse_args(sys.argv[1:])
+    argv = sys.argv[1:]
+    qname, qtype = parse_args(list(argv))
+
+    Options.transport = transport_name(ctx.dns_transport_list)
+    if Options.presentation or Options.json:
+        # large block buffer for the high volume of short output lines
+        sys.stdout = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 1 << 16)
+    if Options.cachesize:
+        ctx = getdns_cache.CachingContext(ctx, Options.cachesize)
+    if Options.keep_open:
+        if Options.idle_timeout is None:
+            # keep upstream connections open (and warm between
+            # interactive queries), so queries are pipelined on them
+            if Options.interactive:
+                Options.idle_timeout = INTERACTIVE_IDLE_TIMEOUT
+            else:
+                Options.idle_timeout = KEEP_OPEN_IDLE_TIMEOUT
+            ctx.idle_timeout = Options.idle_timeout
+    if (Options.keep_open and Options.conn_stats) or \
+       len(Upstreams.servers) > 1:
+        # call reporting tells which upstream each query went to
+        Exts['return_call_debugging'] = getdns.EXTENSION_TRUE
 
     if Options.api_info:
         pprint.pprint(ctx.get_api_information())
@@ -439,23 +1140,39 @@ if __name__ == '__main__':
         sys.exit(0)
 
     t1 = time.time()
-    if Options.async:
-        if Options.filename:
-            tids = []
-            for line in open(Options.filename):
-                qname, qtype = line.split()
-                tids.append(do_query_async(ctx, qname, qtype))
+    filename = '-' if Options.shard else Options.filename
+    try:
+        if Options.interactive:
+            interactive(ctx)
+        elif Options.nworkers > 1 and not Options.shard:
+            run_workers(argv, Options.nworkers)
+        elif Options.async_mode:
+            if filename:
+                Batch.queries = read_queries(filename)
+            else:
+                Batch.queries = iter([(qname, qtype)])
+            fill_window(ctx)
             ctx.run()
         else:
-            tid = do_query_async(ctx, qname, qtype)
-            ctx.run()
-    else:
-        if Options.filename:
-            for line in open(Options.filename):
-                qname, qtype = line.split()
+            if filename:
+                for qname, qtype in read_queries(filename):
+                    do_query(ctx, qname, qtype)
+            else:
                 do_query(ctx, qname, qtype)
-        else:
-            do_query(ctx, qname, qtype)
+    finally:
+        if Options.cachesize:
+            Stats.cache_hits += ctx.cache.hits
+            Stats.cache_misses += ctx.cache.misses
+        if Options.shard:
+            # also when a query error ends the worker with sys.exit()
+            print(STATS_MARKER + json.dumps(stats_dict()))
+            sys.stdout.flush()
 
     elapsed = time.time() - t1
-    print("\nElapsed time: {:.3f}s".format(elapsed))
+    if not Options.shard:
+        if Options.json:
+            # keep stdout to JSON lines only
+            sys.stdout.flush()
+            sys.stdout = sys.stderr
+        print_stats(elapsed)
+    sys.stdout.flush()
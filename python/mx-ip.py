@@ -4,49 +4,134 @@
 """
 Lookup an MX record and printout all the MX preference, target, and
 associated IP addresses of the targets.
+
+Addresses of the MX targets are taken from the additional section of
+the MX response where present, saving a round trip per target; only
+targets without such glue are looked up, concurrently. (The additional
+section may hold addresses of only one family for a target, so glue is
+only used for targets with both A and AAAA records in it.)
 """
 
-import getdns, pprint, sys
+import getdns, pprint, sys, socket, os.path
+import getdns_cache
 
 extensions = {}
 
-def get_ip(ctx, qname):
-    iplist = []
-    results = ctx.address(name=qname, extensions=extensions)
-    if results.status == getdns.RESPSTATUS_GOOD:
-        for addr in results.just_address_answers:
-            iplist.append(addr['address_data'])
-    else:
-        print("getdns.address() returned an error: %d" % results.status)
-    return iplist
+
+def address_text(af, address):
+    """Return printable form of an A/AAAA rdata address"""
+    if isinstance(address, str):
+        return address
+    try:
+        address = address.tobytes()
+    except AttributeError:
+        pass
+    return socket.inet_ntop(af, address)
+
+
+def get_glue(results):
+    """Return dictionary of exchange name -> list of IP addresses from
+    A and AAAA records in the additional sections of the MX replies.
+    Only exchanges with records of both types are included: an address
+    lookup returns both, and servers may leave out either to keep the
+    response small."""
+    addresses = {}                      # name -> {rrtype: [ips]}
+    for reply in results.replies_tree:
+        for rr in reply.get('additional', []):
+            if rr['type'] == getdns.RRTYPE_A:
+                ip = address_text(socket.AF_INET, rr['rdata']['ipv4_address'])
+            elif rr['type'] == getdns.RRTYPE_AAAA:
+                ip = address_text(socket.AF_INET6,
+                                  rr['rdata']['ipv6_address'])
+            else:
+                continue
+            byfamily = addresses.setdefault(rr['name'].lower(), {})
+            byfamily.setdefault(rr['type'], []).append(ip)
+    glue = {}
+    for name, byfamily in addresses.items():
+        if len(byfamily) == 2:
+            glue[name] = byfamily[getdns.RRTYPE_A] + \
+                         byfamily[getdns.RRTYPE_AAAA]
+    return glue
+
+
+def get_ips_async(ctx, qnames):
+    """Look up addresses of all qnames concurrently, returning a
+    dictionary of qname -> list of IP addresses"""
+    iplists = {}
+
+    def callback(cbtype, results, qname, tid):
+        iplists[qname] = []
+        if cbtype != getdns.CALLBACK_COMPLETE:
+            print("%s: address lookup failed, callback type %d" %
+                  (qname, cbtype))
+        elif results.status == getdns.RESPSTATUS_GOOD:
+            for addr in results.just_address_answers:
+                iplists[qname].append(addr['address_data'])
+        else:
+            print("getdns.address() returned an error: %d" % results.status)
+
+    for qname in qnames:
+        try:
+            ctx.address(name=qname, extensions=extensions, callback=callback,
+                        userarg=qname)
+        except getdns.error as e:
+            print("%s: address lookup failed: %s" % (qname, e))
+            iplists[qname] = []
+    ctx.run()
+    return iplists
 
 
 if __name__ == '__main__':
 
-    qname = sys.argv[1]
+    args = sys.argv[1:]
+    use_cache = True
+    if args and args[0] == '-n':
+        use_cache = False
+        args.pop(0)
+    if len(args) != 1:
+        print("Usage: %s [-n] <domain>\n\n    -n: don't use the response "
+              "cache" % os.path.basename(sys.argv[0]))
+        sys.exit(1)
+    qname = args[0]
 
     ctx = getdns.Context()
+    if use_cache:
+        ctx = getdns_cache.CachingContext(ctx)
     results = ctx.general(name=qname, request_type=getdns.RRTYPE_MX)
     status = results.status
 
     hostlist = []
     if status == getdns.RESPSTATUS_GOOD:
+        mxlist = []
         for reply in results.replies_tree:
             answers = reply['answer']
             for answer in answers:
                 if answer['type'] == getdns.RRTYPE_MX:
-                    iplist = get_ip(ctx, answer['rdata']['exchange'])
-                    for ip in iplist:
-                        hostlist.append( (answer['rdata']['preference'], \
-                                          answer['rdata']['exchange'], ip) )
+                    mxlist.append( (answer['rdata']['preference'],
+                                    answer['rdata']['exchange']) )
+        glue = get_glue(results)
+        exchanges = set(mx for (pref, mx) in mxlist)
+        missing = [mx for mx in exchanges if mx.lower() not in glue]
+        iplists = get_ips_async(ctx, missing)
+        for mx in exchanges:
+            if mx not in iplists:
+                iplists[mx] = glue[mx.lower()]
+        for (pref, mx) in mxlist:
+            for ip in iplists[mx]:
+                hostlist.append( (pref, mx, ip) )
+        saved = len(exchanges) - len(missing)
     elif status == getdns.RESPSTATUS_NO_NAME:
-        print("%s, %s: no such name" % (qname, qtype))
+        print("%s, MX: no such name" % qname)
     elif status == getdns.RESPSTATUS_ALL_TIMEOUT:
-        print("%s, %s: query timed out" % (qname, qtype))
+        print("%s, MX: query timed out" % qname)
     else:
-        print("%s, %s: unknown return code: %d" % status)
+        print("%s, MX: unknown return code: %d" % (qname, status))
 
     for (pref, mx, addr) in sorted(hostlist):
         print("%d %s %s" % (pref, mx, addr))
 
-
+    if status == getdns.RESPSTATUS_GOOD:
+        print("(%d of %d exchanges had A and AAAA glue in the additional "
+              "section: %d address queries saved)" %
+              (saved, len(exchanges), saved))
@@ -4,18 +4,32 @@
 """
 Lookup an NS record and printout all the hostnames and associated IP
 addresses of the listed nameservers.
+
+With -f, read many zones from a file (or stdin), resolve their NS sets
+and the nameserver addresses asynchronously with a limit on the number
+of queries in flight, and stream out "<zone> <nsdname> <ip>" rows as
+the answers arrive. Nameserver addresses are only looked up once, and
+shared across all zones that use the same nameserver.
 """
 
-import getdns, pprint, sys, os.path
+import getdns, pprint, sys, os.path, time
+from collections import deque
+import getdns_cache
 
 extensions = {}
 
 
 def usage():
     progname = os.path.basename(sys.argv[0])
-    print("""Usage: {0} <zone>
+    print("""Usage: {0} [-n] <zone>
+       {0} [-c concurrency] -f <file>
 
 where <zone> is a DNS zone (domain).
+
+    -n: don't use the response cache
+    -f file: bulk mode, read zones one per line from file ("-" for stdin)
+    -c concurrency: max number of queries in flight in bulk mode
+                    (default 100)
 """.format(progname))
     sys.exit(1)
 
@@ -31,14 +45,159 @@ def get_ip(ctx, qname):
     return iplist
 
 
+class Bulk:
+    """State of the bulk (-f) mode"""
+    window          = 100           # max number of queries in flight
+    zones           = None          # iterator of zones to query
+    inflight        = 0
+    nsdnames        = deque()       # nameservers waiting to be queried
+    addresses       = dict()        # nsdname -> IP address list
+    waiting         = dict()        # nsdname -> zones waiting for it
+    zone_count      = 0
+    ns_count        = 0             # (zone, nsdname) pairs
+    address_lookups = 0
+
+
+def read_zones(f):
+    """Generate zone names from a file object, one per line"""
+    for line in f:
+        fields = line.split()
+        if fields and not fields[0].startswith('#'):
+            yield fields[0]
+
+
+def print_rows(zone, nsdname):
+    for ip in Bulk.addresses[nsdname]:
+        sys.stdout.write("%s %s %s\n" % (zone, nsdname, ip))
+
+
+def fill_window(ctx):
+    """Submit queued nameserver address queries, then NS queries for
+    new zones, until the window is full"""
+    while Bulk.inflight < Bulk.window:
+        if Bulk.nsdnames:
+            nsdname = Bulk.nsdnames.popleft()
+            try:
+                ctx.address(name=nsdname, extensions=extensions,
+                            callback=address_callback, userarg=nsdname)
+            except getdns.error as e:
+                sys.stderr.write("%s: %s\n" % (nsdname, e))
+                Bulk.addresses[nsdname] = []
+                Bulk.waiting.pop(nsdname, None)
+                continue
+            Bulk.address_lookups += 1
+        elif Bulk.zones is not None:
+            try:
+                zone = next(Bulk.zones)
+            except StopIteration:
+                Bulk.zones = None
+                break
+            try:
+                ctx.general(name=zone, request_type=getdns.RRTYPE_NS,
+                            extensions=extensions, callback=ns_callback,
+                            userarg=zone)
+            except getdns.error as e:
+                sys.stderr.write("%s: %s\n" % (zone, e))
+                continue
+            Bulk.zone_count += 1
+        else:
+            break
+        Bulk.inflight += 1
+    return
+
+
+def ns_callback(cbtype, results, zone, tid):
+    """Callback for NS queries: print rows for nameservers whose
+    addresses are known, and queue lookups for the others"""
+    Bulk.inflight -= 1
+    if cbtype != getdns.CALLBACK_COMPLETE:
+        sys.stderr.write("%s, NS: query failed, callback type %d\n" %
+                         (zone, cbtype))
+    elif results.status == getdns.RESPSTATUS_GOOD:
+        nsdnames = set()
+        for reply in results.replies_tree:
+            for answer in reply['answer']:
+                if answer['type'] == getdns.RRTYPE_NS:
+                    nsdnames.add(answer['rdata']['nsdname'].lower())
+        for nsdname in sorted(nsdnames):
+            Bulk.ns_count += 1
+            if nsdname in Bulk.addresses:
+                print_rows(zone, nsdname)
+            elif nsdname in Bulk.waiting:
+                Bulk.waiting[nsdname].append(zone)
+            else:
+                Bulk.waiting[nsdname] = [zone]
+                Bulk.nsdnames.append(nsdname)
+    elif results.status == getdns.RESPSTATUS_NO_NAME:
+        sys.stderr.write("%s: no such DNS zone\n" % zone)
+    elif results.status == getdns.RESPSTATUS_ALL_TIMEOUT:
+        sys.stderr.write("%s, NS: query timed out\n" % zone)
+    else:
+        sys.stderr.write("%s, NS: unknown return code: %d\n" %
+                         (zone, results.status))
+    fill_window(ctx)
+
+
+def address_callback(cbtype, results, nsdname, tid):
+    """Callback for nameserver address queries: print rows for all the
+    zones waiting on this nameserver"""
+    Bulk.inflight -= 1
+    iplist = []
+    if cbtype == getdns.CALLBACK_COMPLETE and \
+       results.status == getdns.RESPSTATUS_GOOD:
+        for addr in results.just_address_answers:
+            iplist.append(addr['address_data'])
+    else:
+        sys.stderr.write("%s: address lookup failed\n" % nsdname)
+    Bulk.addresses[nsdname] = iplist
+    for zone in Bulk.waiting.pop(nsdname, []):
+        print_rows(zone, nsdname)
+    fill_window(ctx)
+
+
 if __name__ == '__main__':
 
-    if len(sys.argv) != 2:
+    args = sys.argv[1:]
+    filename = None
+    use_cache = True
+    while args and args[0].startswith('-') and args[0] != '-':
+        opt = args.pop(0)
+        if opt == '-f' and args:
+            filename = args.pop(0)
+        elif opt == '-c' and args:
+            Bulk.window = int(args.pop(0))
+        elif opt == '-n':
+            use_cache = False
+        else:
+            usage()
+
+    if filename:
+
+        if args:
+            usage()
+        t1 = time.time()
+        f = sys.stdin if filename == '-' else open(filename)
+        ctx = getdns.Context()
+        Bulk.zones = read_zones(f)
+        fill_window(ctx)
+        ctx.run()
+        sys.stdout.flush()
+        sys.stderr.write("%d zones, %d nameserver references, %d address "
+                         "lookups (%d shared), %.3fs\n" %
+                         (Bulk.zone_count, Bulk.ns_count,
+                          Bulk.address_lookups,
+                          Bulk.ns_count - Bulk.address_lookups,
+                          time.time() - t1))
+        sys.exit(0)
+
+    if len(args) != 1:
         usage()
 
-    qname = sys.argv[1]
+    qname = args[0]
 
     ctx = getdns.Context()
+    if use_cache:
+        ctx = getdns_cache.CachingContext(ctx)
     results = ctx.general(name=qname, request_type=getdns.RRTYPE_NS)
     status = results.status
 
@@ -61,4 +220,3 @@ if __name__ == '__main__':
     # Print out each NS server name and IP address
     for (nsdname, addr) in sorted(hostlist):
         print("%s %s" % (nsdname, addr))
-
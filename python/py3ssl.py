@@ -1,14 +1,47 @@
 #!/usr/bin/env python3
 #
-# 
+# Connect to each address of a TLS server, and print the negotiated
+# TLS version and the server certificate.
+#
+# With -s, TLS sessions are cached in memory (see sessioncache.py), so
+# that connections to the second and later addresses resume the session
+# of the first; resumption statistics are printed at the end.
+#
+# With -f, harvest certificates from many servers: read host[:port]
+# targets from a file (or stdin), connect to up to -c of them at a time,
+# all with one shared SSLContext (so the CA bundle is only parsed once),
+# and stream out a JSON line per target with the negotiated version and
+# cipher, the certificate chain, and its expiry. Each target's addresses
+# are tried in "happy eyeballs" order (RFC 8305): address families
+# interleaved, with the next connection attempt started if the previous
+# ones have not connected after HE_DELAY seconds.
+#
+
+import os.path, sys, socket, hashlib, pprint, getopt, time
+import ssl, json, threading, selectors, select, errno
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import sessioncache
+
+HE_DELAY = 0.25                         # happy eyeballs attempt delay
+TIMEOUT = 10                            # seconds, connect and handshake
+CONCURRENCY = 50                        # harvester connections at a time
+TICKET_WAIT = 0.5                       # max wait for TLS 1.3 tickets (-s)
 
-import os.path, sys, socket, hashlib, pprint
-import ssl
 
 def usage():
     print("""\
-Usage: {0} [hostname] [port]\
-""".format(os.path.basename(sys.argv[0])))
+Usage: {0} [-s] [hostname] [port]
+       {0} [-s] [-c concurrency] [-t timeout] -f <file>
+
+    -s: cache and resume TLS sessions
+    -f file: harvester mode, read host[:port] targets one per line from
+             file ("-" for stdin)
+    -c concurrency: number of concurrent connections (default {1})
+    -t timeout: connect and handshake timeout in seconds (default {2})\
+""".format(os.path.basename(sys.argv[0]), CONCURRENCY, TIMEOUT))
     sys.exit(1)
 
 
@@ -29,40 +62,296 @@ def get_certbundle():
             return f
     else:
         raise Exception("unable to find CA certificate bundle location")
-        
+
+
+def make_context(certbundle):
+    """Return the SSLContext for all connections. Sessions can only be
+    resumed with the context that created them, and loading the CA
+    bundle is expensive, so it is made once."""
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2
+    context.options |= ssl.OP_NO_SSLv3
+    context.options |= ssl.OP_NO_TLSv1
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = True
+    context.load_verify_locations(certbundle)
+    return context
+
+
+def parse_target(target, default_port=443):
+    """Split host[:port] (or [ipv6]:port) into (host, port)"""
+    if target.startswith('['):
+        host, _, rest = target[1:].partition(']')
+        return host, int(rest[1:]) if rest.startswith(':') else default_port
+    if target.count(':') == 1:
+        host, port = target.split(':')
+        return host, int(port)
+    return target, default_port
+
+
+def read_targets(f):
+    """Generate targets from a file object, one per line"""
+    for line in f:
+        fields = line.split()
+        if fields and not fields[0].startswith('#'):
+            yield fields[0]
+
+
+def happy_eyeballs_order(ai_list):
+    """Interleave getaddrinfo results by address family, starting with
+    the family of the first one (RFC 8305, section 4)"""
+    families = []
+    by_family = {}
+    for ai in ai_list:
+        if ai[0] not in by_family:
+            families.append(ai[0])
+            by_family[ai[0]] = []
+        by_family[ai[0]].append(ai)
+    ordered = []
+    while any(by_family.values()):
+        for af in families:
+            if by_family[af]:
+                ordered.append(by_family[af].pop(0))
+    return ordered
+
+
+def happy_eyeballs_connect(ai_list, timeout=TIMEOUT, delay=HE_DELAY):
+    """Connect to the first address of ai_list to accept a connection,
+    starting a new attempt every delay seconds while none has. Returns
+    (socket, sockaddr); the socket is blocking with the given timeout."""
+    pending = list(happy_eyeballs_order(ai_list))
+    sel = selectors.DefaultSelector()
+    deadline = time.time() + timeout
+    last_error = socket.timeout("connect timed out")
+    try:
+        while pending or sel.get_map():
+            if pending:
+                (af, socktype, proto, cano, saddr) = pending.pop(0)
+                sock = socket.socket(af, socktype, proto)
+                sock.setblocking(False)
+                err = sock.connect_ex(saddr)
+                if err == 0:
+                    sock.settimeout(timeout)
+                    return sock, saddr
+                elif err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    last_error = socket.error(err, os.strerror(err))
+                    sock.close()
+                else:
+                    sel.register(sock, selectors.EVENT_WRITE, saddr)
+                if not sel.get_map():
+                    continue
+            wait = deadline - time.time()
+            if wait <= 0:
+                break
+            if pending:
+                wait = min(wait, delay)
+            for (key, events) in sel.select(wait):
+                sock = key.fileobj
+                sel.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    sock.settimeout(timeout)
+                    return sock, key.data
+                last_error = socket.error(err, os.strerror(err))
+                sock.close()
+        raise last_error
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+
+
+def read_session_ticket(conn, wait=TICKET_WAIT):
+    """Process a TLS 1.3 session ticket, which the server sends after
+    the handshake, and which is only picked up by a read. Waits at most
+    wait seconds for it to arrive."""
+    conn.setblocking(False)
+    deadline = time.time() + wait
+    while not conn.session.has_ticket:
+        try:
+            conn.recv(1)
+        except ssl.SSLWantReadError:
+            pass
+        except socket.error:
+            return
+        remaining = deadline - time.time()
+        if conn.session.has_ticket or remaining <= 0:
+            return
+        select.select([conn], [], [], remaining)
+
+
+def cert_summary(cert):
+    """Return dictionary of the main fields of a getpeercert() style
+    certificate dictionary"""
+    subject = dict(x[0] for x in cert.get('subject', ()))
+    issuer = dict(x[0] for x in cert.get('issuer', ()))
+    summary = dict(subject=subject.get('commonName'),
+                   issuer=issuer.get('commonName'),
+                   notBefore=cert.get('notBefore'),
+                   notAfter=cert.get('notAfter'))
+    if 'notAfter' in cert:
+        expiry = ssl.cert_time_to_seconds(cert['notAfter'])
+        summary['expires_in_days'] = int((expiry - time.time()) // 86400)
+    return summary
+
+
+def harvest(context, target, timeout=TIMEOUT, sessions=None):
+    """Connect to a host[:port] target and return a dictionary of the
+    TLS connection and certificate details, or the error"""
+    record = dict(target=target)
+    try:
+        host, port = parse_target(target)
+        record.update(host=host, port=port)
+        ai_list = socket.getaddrinfo(host, port, socket.AF_UNSPEC,
+                                     socket.SOCK_STREAM)
+        t0 = time.time()
+        sock, saddr = happy_eyeballs_connect(ai_list, timeout)
+        record['address'] = saddr[0]
+        session = sessions.get(host, port) if sessions else None
+        t1 = time.time()
+        try:
+            conn = context.wrap_socket(sock, server_hostname=host,
+                                       session=session)
+        except Exception:
+            sock.close()
+            raise
+        handshake = time.time() - t1
+        with conn:
+            if sessions and conn.version() == 'TLSv1.3':
+                read_session_ticket(conn)
+                conn.settimeout(timeout)
+            if sessions:
+                sessions.record(host, port, conn.session,
+                                conn.session_reused, handshake)
+                record['resumed'] = conn.session_reused
+            record['connect_ms'] = round((t1 - t0) * 1000, 1)
+            record['handshake_ms'] = round(handshake * 1000, 1)
+            record['version'] = conn.version()
+            record['cipher'] = conn.cipher()[0]
+            try:
+                # Python 3.13+; otherwise only the end-entity certificate
+                chain = [c.get_info() for c in conn.get_verified_chain()]
+            except AttributeError:
+                chain = [conn.getpeercert()]
+            record['chain'] = [cert_summary(c) for c in chain]
+            if record['chain']:
+                record['notAfter'] = record['chain'][0].get('notAfter')
+                record['expires_in_days'] = \
+                    record['chain'][0].get('expires_in_days')
+    except (socket.error, ssl.SSLError, ssl.CertificateError,
+            ValueError) as e:
+        record['error'] = str(e)
+    return record
+
+
+def harvester(context, targets, concurrency=CONCURRENCY, timeout=TIMEOUT,
+              sessions=None):
+    """Harvest all targets with concurrency worker threads, writing a
+    JSON line per target as each one completes"""
+    work = queue.Queue(maxsize=concurrency * 2)
+    lock = threading.Lock()
+    counts = dict(targets=0, errors=0)
+
+    def worker():
+        while True:
+            target = work.get()
+            if target is None:
+                return
+            record = harvest(context, target, timeout, sessions)
+            line = json.dumps(record)
+            with lock:
+                counts['targets'] += 1
+                if 'error' in record:
+                    counts['errors'] += 1
+                sys.stdout.write(line + "\n")
+                sys.stdout.flush()
+
+    threads = []
+    for i in range(concurrency):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    for target in targets:
+        work.put(target)
+    for t in threads:
+        work.put(None)
+    for t in threads:
+        t.join()
+    return counts
+
 
 if __name__ == '__main__':
 
-    if (len(sys.argv) < 2) or (len(sys.argv) > 3):
+    try:
+        (options, args) = getopt.getopt(sys.argv[1:], 'sf:c:t:')
+    except getopt.GetoptError:
+        usage()
+    sessions = None
+    filename = None
+    concurrency = CONCURRENCY
+    timeout = TIMEOUT
+    for (opt, optval) in options:
+        if opt == '-s':
+            sessions = sessioncache.SessionCache()
+        elif opt == '-f':
+            filename = optval
+        elif opt == '-c':
+            concurrency = int(optval)
+        elif opt == '-t':
+            timeout = float(optval)
+
+    if filename:
+        if args:
+            usage()
+        t1 = time.time()
+        context = make_context(get_certbundle())
+        f = sys.stdin if filename == '-' else open(filename)
+        counts = harvester(context, read_targets(f), concurrency, timeout,
+                           sessions)
+        sys.stderr.write("%d targets, %d errors, %.3fs\n" %
+                         (counts['targets'], counts['errors'],
+                          time.time() - t1))
+        if sessions:
+            sys.stderr.write(sessions.report() + "\n")
+        sys.exit(0)
+
+    if (len(args) < 1) or (len(args) > 2):
         usage()
     else:
-        hostname = sys.argv[1]
+        hostname = args[0]
         try:
-            port = int(sys.argv[2])
+            port = int(args[1])
         except:
             port = 443
 
     certbundle = get_certbundle()
-    ai_list = socket.getaddrinfo(hostname, port, 
+    ai_list = socket.getaddrinfo(hostname, port,
                                  socket.AF_UNSPEC, socket.SOCK_STREAM)
 
+    context = make_context(certbundle)
+
     for (af, socktype, proto, cano, saddr) in ai_list:
 
         ipaddr, port = saddr[0:2]
 
         print("\nConnecting to %s at address %s ..." % (hostname, ipaddr))
 
-        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        context.options |= ssl.OP_NO_SSLv2
-        context.options |= ssl.OP_NO_SSLv3
-        context.options |= ssl.OP_NO_TLSv1
-        context.verify_mode = ssl.CERT_REQUIRED
-        context.check_hostname = True
-        context.load_verify_locations(certbundle)
-
+        session = sessions.get(hostname, port) if sessions else None
         conn = context.wrap_socket(socket.socket(af, socktype),
-                                   server_hostname=hostname)
+                                   server_hostname=hostname,
+                                   session=session)
+        t0 = time.time()
         conn.connect((ipaddr, port))
+        elapsed = time.time() - t0
+        if sessions:
+            if conn.version() == 'TLSv1.3':
+                read_session_ticket(conn)
+                conn.setblocking(True)
+            sessions.record(hostname, port, conn.session,
+                            conn.session_reused, elapsed)
+            if conn.session_reused:
+                print("Resumed TLS session")
         try:
             # Needs a very recent Python version
             print("Negotiated TLS version: %s" % conn.version())
@@ -73,3 +362,6 @@ if __name__ == '__main__':
 
         print("Closing connection ..")
         conn.close()
+
+    if sessions:
+        print("\n" + sessions.report())
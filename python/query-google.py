@@ -1,10 +1,21 @@
 #!/usr/bin/env python
-# 
+#
 # Use stub mode with google public DNS as recursive resolvers
 # to query addresses associated with a host.
 #
+# With -d <delay_ms>, queries are hedged: the query goes to the first
+# Google address, and if no answer has arrived after delay_ms, the same
+# query is also sent to the second one; whichever answers first wins.
+# Counts of hedged queries and the latency they saved are printed at
+# the end. Hedged lookups run in resolver processes, one per query in
+# flight, as the getdns bindings hold the GIL while a lookup runs.
+#
 
-import getdns, sys, pprint
+import getdns, sys, pprint, getopt, os.path, time, multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 google_public_dns = [
     {'address_data': '8.8.8.8', 'address_type': 'IPv4'},
@@ -13,24 +24,201 @@ google_public_dns = [
     {'address_data': '2001:4860:4860::8844', 'address_type': 'IPv6'},
 ]
 
-hostname = sys.argv[1]
-
-ctx = getdns.Context()
-ctx.resolution_type = getdns.RESOLUTION_STUB
-ctx.upstream_recursive_servers = google_public_dns
 extensions = {}
 
-try:
-    results = ctx.address(name=hostname, extensions=extensions)
-except (getdns.error, e):
-    print(str(e))
+
+def usage():
+    print("""\
+Usage: {0} [-d delay_ms] <hostname> [<hostname> ...]
+
+    -d delay_ms: hedge queries: if the first upstream has not answered
+                 after delay_ms, query the second one too
+""".format(os.path.basename(sys.argv[0])))
     sys.exit(1)
 
-if results.status == getdns.RESPSTATUS_GOOD:
-    for addr in results.just_address_answers:
-        print(addr["address_data"])
-elif results.status == getdns.RESPSTATUS_NO_NAME:
-    print("%s: No such domain name" % hostname)
-else:
-    print("getdns.address() returned an error: %d" % results.status)
 
+def make_context(upstreams):
+    ctx = getdns.Context()
+    ctx.resolution_type = getdns.RESOLUTION_STUB
+    ctx.upstream_recursive_servers = upstreams
+    return ctx
+
+
+def address_summary(results):
+    """Return (status, list of addresses) of address() results"""
+    return (results.status,
+            [addr["address_data"] for addr in results.just_address_answers])
+
+
+def resolver_main(index, upstream, requests, answers):
+    """Resolver process body: look up the (query id, hostname) requests
+    with a Context for upstream, and report each to the answers queue as
+    (query id, index, finish time, (status, addresses)), or with status
+    None and the error text."""
+    ctx = make_context([upstream])
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        qid, hostname = request
+        try:
+            results = ctx.address(name=hostname, extensions=extensions)
+            answer = address_summary(results)
+        except getdns.error as e:
+            answer = (None, str(e))
+        answers.put((qid, index, time.time(), answer))
+
+
+class ResolverPool:
+    """Idle resolver processes for each single upstream. The getdns
+    bindings keep the GIL for the whole of a lookup (sync, or run() for
+    async ones), so while one is in progress no timer, thread or
+    callback of the same process runs, and the hedge could not fire.
+    Each lookup runs in a process of its own instead; a query in flight
+    takes one out, and its answer puts it back."""
+
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+        self.answers = multiprocessing.Queue()
+        self.idle = [[] for x in upstreams]
+        self.busy = {}                  # (query id, index) -> requests
+
+    def submit(self, index, hq):
+        if self.idle[index]:
+            requests = self.idle[index].pop()
+        else:
+            requests = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=resolver_main,
+                args=(index, self.upstreams[index], requests, self.answers))
+            process.daemon = True
+            process.start()
+        self.busy[(hq.qid, index)] = requests
+        requests.put((hq.qid, hq.hostname))
+        hq.pending.add(index)
+
+    def get(self, queries, timeout=None):
+        """Wait for the next answer, record it with its query, and return
+        that HedgedQuery; raises queue.Empty after timeout seconds"""
+        qid, index, finished, answer = self.answers.get(timeout=timeout)
+        self.idle[index].append(self.busy.pop((qid, index)))
+        hq = queries[qid]
+        hq.pending.discard(index)
+        hq.elapsed[index] = finished - hq.start
+        hq.answers[index] = answer
+        return hq
+
+    def close(self):
+        for requests in [r for idle in self.idle for r in idle] + \
+                list(self.busy.values()):
+            requests.put(None)
+
+
+class HedgedQuery:
+    """An address query sent to a primary and maybe a hedge upstream"""
+
+    def __init__(self, qid, hostname):
+        self.qid = qid
+        self.hostname = hostname
+        self.start = time.time()
+        self.elapsed = {}                # upstream index -> seconds
+        self.answers = {}                # upstream index -> answer
+        self.pending = set()             # upstream indexes in flight
+        self.hedged = False
+        self.winner = None
+
+
+def is_answer(answer):
+    return answer[0] is not None and \
+        answer[0] != getdns.RESPSTATUS_ALL_TIMEOUT
+
+
+def hedged_address(pool, queries, hostname, delay):
+    """Resolve hostname, hedging to the second upstream after delay
+    seconds. Returns (HedgedQuery, answer). The losing lookup is left
+    to finish in its process; its time is only used for statistics."""
+    hq = HedgedQuery(len(queries), hostname)
+    queries[hq.qid] = hq
+    pool.submit(0, hq)
+    while hq.winner is None:
+        timeout = None
+        if not hq.hedged:
+            timeout = max(0.0, hq.start + delay - time.time())
+        try:
+            done = pool.get(queries, timeout)
+        except queue.Empty:
+            hq.hedged = True
+            pool.submit(1, hq)
+            continue
+        if done is not hq:
+            continue                     # a loser of an earlier query
+        for index, answer in hq.answers.items():
+            # the first to finish may have failed; the other one may
+            # still do better
+            if is_answer(answer) or not hq.pending:
+                hq.winner = index
+                break
+    return hq, hq.answers[hq.winner]
+
+
+def print_results(hostname, answer):
+    status, data = answer
+    if status is None:
+        print(data)
+    elif status == getdns.RESPSTATUS_GOOD:
+        for address in data:
+            print(address)
+    elif status == getdns.RESPSTATUS_NO_NAME:
+        print("%s: No such domain name" % hostname)
+    else:
+        print("getdns.address() returned an error: %d" % status)
+
+
+def print_hedge_stats(pool, queries):
+    """Print how often hedging fired, and the latency it saved: for
+    queries won by the hedge, the time the primary took (or would still
+    have taken) beyond the hedge's answer."""
+    while any(hq.pending for hq in queries.values()):
+        pool.get(queries)
+    queries = list(queries.values())
+    fired = [hq for hq in queries if hq.hedged]
+    won = [hq for hq in fired if hq.winner == 1]
+    saved = sum(hq.elapsed[0] - hq.elapsed[1] for hq in won)
+    print("\nQueries: %d, hedged: %d (%.1f%%), won by hedge: %d, "
+          "latency saved: %.1fms total, %.1fms per hedged query" %
+          (len(queries), len(fired), 100.0 * len(fired) / len(queries),
+           len(won), saved * 1000,
+           (saved * 1000 / len(fired)) if fired else 0.0))
+
+
+if __name__ == '__main__':
+
+    try:
+        (options, args) = getopt.getopt(sys.argv[1:], 'd:')
+    except getopt.GetoptError:
+        usage()
+    if not args:
+        usage()
+
+    delay = None
+    for (opt, optval) in options:
+        if opt == '-d':
+            delay = int(optval) / 1000.0
+
+    if delay is None:
+        ctx = make_context(google_public_dns)
+        for hostname in args:
+            try:
+                results = ctx.address(name=hostname, extensions=extensions)
+            except getdns.error as e:
+                print(str(e))
+                sys.exit(1)
+            print_results(hostname, address_summary(results))
+    else:
+        pool = ResolverPool(google_public_dns)
+        queries = {}                     # query id -> HedgedQuery
+        for hostname in args:
+            hq, answer = hedged_address(pool, queries, hostname, delay)
+            print_results(hostname, answer)
+        print_hedge_stats(pool, queries)
+        pool.close()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#
+
+"""
+sessioncache.py
+
+A TLS session resumption cache, keyed by "host:port", for tools that
+connect to the same servers over and over (checkdanecert.py,
+get-dane-url.py, py3ssl.py). Offering a cached session (ID or ticket)
+lets the server skip the full handshake.
+
+Sessions are kept in memory, and with a directory also on disk, so
+that later runs can resume them: M2Crypto SSL.Session objects are
+stored there as PEM files, readable by the owner only. Python
+ssl.SSLSession objects cannot be serialized, and are only cached in
+memory.
+
+A resumed handshake does not send the server's certificate chain, so
+the chain of the full handshake can be recorded with the session (as a
+list of PEM certificates), and is returned with it by get(host, port,
+with_chain=True), which only returns sessions that have one.
+
+    cache = sessioncache.SessionCache(directory="/var/tmp/tls-sessions")
+
+    session = cache.get(host, port)
+    if session:
+        connection.set_session(session)        # M2Crypto
+    t0 = time.time()
+    connection.connect((ipaddr, port))
+    elapsed = time.time() - t0
+    cache.record(host, port, sessioncache.read_session_ticket(connection),
+                 sessioncache.session_reused(connection, session), elapsed,
+                 chain=[cert.as_pem() for cert in peer_chain])
+    ...
+    print(cache.report())
+
+The cache is thread safe. It counts how often a session was offered
+and resumed, and estimates the handshake time saved from the average
+full and resumed handshake times.
+
+Shumon Huque <shuque@gmail.com>
+"""
+
+import os, select, threading, time
+
+try:
+    from M2Crypto import SSL, BIO, m2
+    from M2Crypto.SSL.Session import Session, load_session
+except ImportError:
+    SSL = BIO = m2 = Session = load_session = None
+
+PEM_CERT_END = b"-----END CERTIFICATE-----"
+TICKET_WAIT = 0.5                       # max wait for TLS 1.3 tickets
+
+
+def session_expiry(session):
+    """Return the time a session expires at, or None if unknown"""
+    try:
+        return session.time + session.timeout                 # ssl
+    except AttributeError:
+        pass
+    try:
+        return session.get_time() + session.get_timeout()     # M2Crypto
+    except AttributeError:
+        return None
+
+
+def session_fields(session):
+    """Return (session ID, start time) of an M2Crypto session, from its
+    text form (M2Crypto has no accessors that work for either)"""
+    fields = {}
+    for line in session.as_text().splitlines():
+        name, sep, value = line.partition(b":")
+        if sep:
+            fields[name.strip()] = value.strip()
+    return fields.get(b"Session-ID"), fields.get(b"Start Time")
+
+
+def connection_session(connection):
+    """Return the resumable session of an M2Crypto connection, or None.
+    Connection.get_session() does not take a reference to the session
+    it frees, so one is taken here with SSL_get1_session()."""
+    ptr = m2.ssl_get1_session(connection.ssl)
+    if ptr is None:
+        return None
+    session = Session(ptr, 1)
+    if not session_fields(session)[0]:
+        return None                     # e.g. TLS 1.3 before a ticket
+    return session
+
+
+def read_session_ticket(connection, wait=TICKET_WAIT):
+    """Return the resumable session of an M2Crypto connection, or None,
+    waiting at most wait seconds for a TLS 1.3 session ticket: the
+    server sends it after the handshake, and only a read picks it up"""
+    session = connection_session(connection)
+    if session is not None or connection.get_version() != "TLSv1.3":
+        return session
+    deadline = time.time() + wait
+    connection.setblocking(0)
+    try:
+        while True:
+            try:
+                connection.read(1)
+            except SSL.SSLError:
+                return None
+            session = connection_session(connection)
+            remaining = deadline - time.time()
+            if session is not None or remaining <= 0:
+                return session
+            select.select([connection.socket], [], [], remaining)
+    finally:
+        connection.setblocking(1)
+
+
+def session_reused(connection, session):
+    """Return whether an M2Crypto connection resumed session. There is
+    no SSL_session_reused() in M2Crypto; a resumed connection keeps the
+    session ID and start time of the session offered."""
+    try:
+        return bool(connection.session_reused())
+    except AttributeError:
+        pass
+    if session is None:
+        return False
+    current = connection_session(connection)
+    return current is not None and \
+        session_fields(current) == session_fields(session)
+
+
+class SessionCache:
+    """In memory (and optionally on disk) TLS sessions by host:port"""
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.sessions = dict()          # "host:port" -> session
+        self.chains = dict()            # "host:port" -> [PEM certificate]
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.offered = 0                # lookups that found a session
+        self.resumed = 0
+        self.full_count = 0
+        self.full_time = 0.0            # seconds in full handshakes
+        self.resumed_time = 0.0         # seconds in resumed handshakes
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+
+    @staticmethod
+    def key(host, port):
+        return "%s:%d" % (host.lower(), port)
+
+    def filename(self, key):
+        name = key.replace(os.sep, "_").replace(":", "_")
+        return os.path.join(self.directory, name + ".pem")
+
+    def get(self, host, port, with_chain=False):
+        """Return the cached session for host:port, or None. With
+        with_chain, return (session, certificate chain) instead, or
+        (None, None) if there is no session with a recorded chain."""
+        key = self.key(host, port)
+        with self.lock:
+            self.lookups += 1
+            session = self.sessions.get(key)
+            if session is None and self.directory and SSL:
+                session = self._load(key)
+            if session is not None:
+                expiry = session_expiry(session)
+                if expiry is not None and expiry <= time.time():
+                    self.sessions.pop(key, None)
+                    self.chains.pop(key, None)
+                    session = None
+            chain = self.chains.get(key)
+            if session is not None and with_chain and chain is None:
+                session = None
+            if session is not None:
+                self.sessions[key] = session
+                self.offered += 1
+            if with_chain:
+                return (session, chain) if session is not None \
+                    else (None, None)
+            return session
+
+    def record(self, host, port, session, reused, elapsed, chain=None):
+        """Record the outcome of a handshake with host:port: the session
+        to keep (if any), whether it was resumed, and how long it took,
+        and the server's certificate chain (a list of PEM certificates)
+        of a full handshake"""
+        key = self.key(host, port)
+        with self.lock:
+            if reused:
+                self.resumed += 1
+                self.resumed_time += elapsed
+            else:
+                self.full_count += 1
+                self.full_time += elapsed
+            if session is None:
+                return
+            if not reused or key not in self.sessions:
+                self.sessions[key] = session
+                if chain is None:
+                    self.chains.pop(key, None)
+                else:
+                    self.chains[key] = chain
+                if self.directory and hasattr(session, "write_bio"):
+                    self._save(key, session, chain)
+
+    def _load(self, key):
+        path = self.filename(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            session = load_session(path)
+        except (SSL.SSLError, IOError, OSError):
+            return None
+        try:
+            with open(path[:-4] + ".chain.pem", "rb") as f:
+                pem = f.read()
+        except (IOError, OSError):
+            return session
+        self.chains[key] = [block.strip() + b"\n" + PEM_CERT_END + b"\n"
+                            for block in pem.split(PEM_CERT_END)
+                            if block.strip()]
+        return session
+
+    def _save(self, key, session, chain=None):
+        path = self.filename(key)
+        buf = BIO.MemoryBuffer()
+        try:
+            session.write_bio(buf)
+        except TypeError:
+            # some M2Crypto releases swap write_bio()'s arguments
+            m2.ssl_session_write_pem(session._ptr(), buf._ptr())
+        self._write(path, buf.read())
+        chainpath = path[:-4] + ".chain.pem"
+        if chain is None:
+            try:
+                os.unlink(chainpath)
+            except OSError:
+                pass
+        else:
+            self._write(chainpath, b"".join(chain))
+
+    @staticmethod
+    def _write(path, data):
+        """Replace the file at path with data, readable by the owner
+        only (sessions hold the master secret)"""
+        tmppath = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            pass
+
+    def hit_rate(self):
+        """Fraction of handshakes that were resumed"""
+        total = self.resumed + self.full_count
+        return float(self.resumed) / total if total else 0.0
+
+    def time_saved(self):
+        """Estimated seconds saved by resumed handshakes, compared to
+        the average full handshake"""
+        if not (self.resumed and self.full_count):
+            return 0.0
+        full_avg = self.full_time / self.full_count
+        return max(0.0, self.resumed * full_avg - self.resumed_time)
+
+    def report(self):
+        """Return a one line summary of the cache statistics"""
+        full_avg = self.full_time / self.full_count if self.full_count \
+                   else 0.0
+        resumed_avg = self.resumed_time / self.resumed if self.resumed \
+                      else 0.0
+        return ("TLS sessions: %d handshakes, %d offered a cached session, "
+                "%d resumed (%.1f%%); full %.1fms, resumed %.1fms avg; "
+                "~%.1fms handshake time saved" %
+                (self.resumed + self.full_count, self.offered, self.resumed,
+                 100.0 * self.hit_rate(), full_avg * 1000,
+                 resumed_avg * 1000, self.time_saved() * 1000))
@@ -4,7 +4,8 @@
 """
 sync-addr.py: resolve given DNS names into IP addresses. The -s switch
 constains answers to only ones secured by DNSSEC. The -4 switch only
-returns IPv4 addresses, the -6 switch only IPv6 addresses.
+returns IPv4 addresses, the -6 switch only IPv6 addresses. The -j switch
+prints one JSON object per name, for bulk resolution jobs.
 
 An example run:
 
@@ -15,23 +16,25 @@ An example run:
 
 """
 
-import getdns, sys, getopt, os.path
+import getdns, sys, getopt, os.path, time, json
 
 def usage():
     progname = os.path.basename(sys.argv[0])
     print("""\
-Usage: {0} [-s] [-4|-6] <domain1> <domain2> ...
+Usage: {0} [-s] [-4|-6] [-j] <domain1> <domain2> ...
 
     -s: only return DNSSEC secured answers
     -4: only return IPv4 address answers
     -6: only return IPv6 address answers
+    -j: print results as JSON lines: qname, qtype, status, latency_ms,
+        answers, dnssec
 
 -4 and -6 are mutually exclusive. If both are specified, IPv6 wins.
 """.format(progname))    
     sys.exit(1)
 
 try:
-    (options, args) = getopt.getopt(sys.argv[1:], 's46')
+    (options, args) = getopt.getopt(sys.argv[1:], 's46j')
 except getopt.GetoptError:
     usage()
 else:
@@ -40,6 +43,39 @@ else:
 
 extensions = { "return_both_v4_and_v6" : getdns.EXTENSION_TRUE }
 desired_addr_type = None
+json_output = False
+
+status_names = dict((getattr(getdns, x), x[11:]) for x in dir(getdns)
+                    if x.startswith('RESPSTATUS_'))
+dnssec_names = dict((getattr(getdns, x), x[7:]) for x in dir(getdns)
+                    if x.startswith('DNSSEC_'))
+
+
+def print_json(hostname, status, latency, results=None, error=None):
+    """Write one JSON object with the outcome of an address lookup. A
+    lookup that failed with an exception has status ERROR and the error
+    message in error."""
+    answers = []
+    dnssec = None
+    if results is not None:
+        if status == getdns.RESPSTATUS_GOOD:
+            for addr in results.just_address_answers:
+                if (desired_addr_type == None) or \
+                   (addr['address_type'] == desired_addr_type):
+                    answers.append(addr['address_data'])
+        for reply in results.replies_tree:
+            if 'dnssec_status' in reply:
+                dnssec = dnssec or []
+                dnssec.append(dnssec_names.get(reply['dnssec_status'],
+                                               reply['dnssec_status']))
+    d = dict(qname=hostname, qtype='ADDRESS',
+             status=status_names.get(status, str(status)),
+             latency_ms=round(latency * 1000, 3),
+             answers=answers, dnssec=dnssec)
+    if error is not None:
+        d['error'] = error
+    sys.stdout.write(json.dumps(d, sort_keys=True) + '\n')
+
 
 for (opt, optval) in options:
     if opt == "-s":
@@ -48,17 +84,25 @@ for (opt, optval) in options:
         desired_addr_type = "IPv4"
     elif opt == "-6":
         desired_addr_type = "IPv6"
+    elif opt == "-j":
+        json_output = True
 
 ctx = getdns.Context()
 
 for hostname in args:
+    t0 = time.time()
     try:
         results = ctx.address(name=hostname, extensions=extensions)
-    except (getdns.error, e):
-        print(str(e))
+    except getdns.error as e:
+        if json_output:
+            print_json(hostname, 'ERROR', time.time() - t0, error=str(e))
+        else:
+            print(str(e))
         break
     status = results.status
-    if status == getdns.RESPSTATUS_GOOD:
+    if json_output:
+        print_json(hostname, status, time.time() - t0, results)
+    elif status == getdns.RESPSTATUS_GOOD:
         for addr in results.just_address_answers:
             addr_type = addr['address_type']
             addr_data = addr['address_data']
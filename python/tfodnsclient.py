@@ -5,55 +5,157 @@
 # (Note: doesn't use getdns. getdns will automatically use TFO if
 # compiled with TFO support).
 #
+# Several queries can be given: they are all sent pipelined, in the
+# first (TFO) segments of a single connection, and the responses, which
+# may arrive in any order, are matched to them by message ID. Responses
+# are read with recv_into() into one preallocated buffer.
+#
 
-import os, os.path, sys
+import os, os.path, sys, time, getopt
 import struct, socket
 import dns.message, dns.rdatatype
 from binascii import hexlify
 
-try:
-    socket.MSG_FASTOPEN
-except:
-    print("No support for TCP Fast Open")
-    sys.exit(1)
-
-RBUFSIZE = 2048
+MAXMSGSIZE = 65535
+TIMEOUT = 5.0                           # seconds to wait for a response
 progname = os.path.basename(sys.argv[0])
 
-try:
-    ip4addr, port, qname, qtype = sys.argv[1:]
-    port = int(port)
-except:
-    print("Usage: %s <addr> <port> <qname> <qtype>" % progname)
+HAVE_TFO = hasattr(socket, 'MSG_FASTOPEN')
+
+
+def usage():
+    print("""\
+Usage: %s [-v] <addr> <port> <qname> <qtype> [<qname> <qtype> ...]
+
+    -v: print the raw responses in hex""" % progname)
     sys.exit(1)
 
 
-msg = dns.message.make_query(qname, qtype, rdclass=1).to_wire()
-msg = struct.pack('!H', len(msg)) + msg
+def make_query(qname, qtype, msgid):
+    """Return a length prefixed DNS query in wire format, with the given
+    message ID"""
+    msg = dns.message.make_query(qname, qtype, rdclass=1)
+    msg.id = msgid
+    wire = msg.to_wire()
+    return struct.pack('!H', len(wire)) + wire
+
+
+class FrameReader:
+    """Read 2-byte length prefixed DNS messages from a stream socket
+    into a single preallocated buffer, without intermediate copies.
+    The memoryview returned by read() is only valid until the next
+    call."""
+
+    def __init__(self, sock, bufsize=MAXMSGSIZE):
+        self.sock = sock
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+
+    def read_exactly(self, n):
+        """Fill the first n octets of the buffer; returns False on EOF
+        before any octet was read, raises EOFError on EOF within"""
+        got = 0
+        while got < n:
+            count = self.sock.recv_into(self.view[got:n], n - got)
+            if count == 0:
+                if got == 0:
+                    return False
+                raise EOFError("connection closed inside a message")
+            got += count
+        return True
+
+    def read(self):
+        """Return the next message as a memoryview, or None on EOF"""
+        if not self.read_exactly(2):
+            return None
+        msglen, = struct.unpack_from('!H', self.buf, 0)
+        if not self.read_exactly(msglen):
+            raise EOFError("connection closed inside a message")
+        return self.view[:msglen]
 
-s = socket
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-octetsSent = 0
-while (octetsSent < len(msg)):
-    sentn = s.sendto(msg[octetsSent:], socket.MSG_FASTOPEN, (ip4addr, port))
+def message_id(wire):
+    """Return the message ID of a DNS message in wire format"""
+    return struct.unpack_from('!H', wire, 0)[0]
+
+
+def tfo_connect_send(address, port, data):
+    """Open a TCP connection to address, port sending data in the SYN
+    with TCP Fast Open (where the kernel has a TFO cookie for the server)
+    and return the socket"""
+    af, socktype, proto, cano, saddr = socket.getaddrinfo(
+        address, port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+    s = socket.socket(af, socktype, proto)
+    sentn = s.sendto(data, socket.MSG_FASTOPEN, saddr)
     if sentn == 0:
-        raise(ValueError, "sendto() returned 0 bytes")
-    octetsSent += sentn
-
-response = b""
-while True:
-    (data, saddr) = s.recvfrom(RBUFSIZE)
-    response += data
-    rlen = len(data)
-    print("DEBUG: Read %d octets" % rlen)
-    if rlen == 0:
-        break
-
-s.close()
-print("\Response=%s\n" % hexlify(response))
-
-resp_len, = struct.unpack('!H', response[0:2])
-resp_msg = response[2:2+resp_len]
-m = dns.message.from_wire(resp_msg)
-print(m)
+        raise ValueError("sendto() returned 0 bytes")
+    if sentn < len(data):
+        s.sendall(data[sentn:])
+    return s
+
+
+def pipeline(address, port, queries, timeout=TIMEOUT):
+    """Send all (qname, qtype) queries pipelined over one TFO connection
+    and return a list of (qname, qtype, response wire, latency) in query
+    order, matching responses by message ID. Responses are waited for
+    until the connection is closed, or nothing arrives for timeout
+    seconds. Queries without a response have None as response and
+    latency; responses to no query are ignored."""
+    wires = []
+    pending = {}                        # message ID -> query index
+    for (index, (qname, qtype)) in enumerate(queries):
+        msgid = index & 0xffff
+        wires.append(make_query(qname, qtype, msgid))
+        pending[msgid] = index
+    results = [(qname, qtype, None, None) for (qname, qtype) in queries]
+
+    t0 = time.time()
+    s = tfo_connect_send(address, port, b"".join(wires))
+    s.settimeout(timeout)
+    reader = FrameReader(s)
+    try:
+        while pending:
+            try:
+                wire = reader.read()
+            except socket.timeout:
+                break
+            if wire is None:
+                break
+            msgid = message_id(wire)
+            if msgid not in pending:
+                continue
+            index = pending.pop(msgid)
+            qname, qtype = queries[index]
+            results[index] = (qname, qtype, bytes(wire), time.time() - t0)
+    finally:
+        s.close()
+    return results
+
+
+if __name__ == '__main__':
+
+    if not HAVE_TFO:
+        print("No support for TCP Fast Open")
+        sys.exit(1)
+
+    try:
+        (options, args) = getopt.getopt(sys.argv[1:], 'v')
+        address, port = args[0:2]
+        port = int(port)
+        qargs = args[2:]
+    except (getopt.GetoptError, ValueError):
+        usage()
+    if not qargs or len(qargs) % 2 or len(qargs) > 2 * 65536:
+        usage()
+    verbose = ('-v', '') in options
+    queries = list(zip(qargs[0::2], qargs[1::2]))
+
+    for (qname, qtype, response, latency) in pipeline(address, port,
+                                                      queries):
+        if response is None:
+            print("%s %s: no response\n" % (qname, qtype))
+            continue
+        print("%s %s: response in %.1fms" % (qname, qtype, latency * 1000))
+        if verbose:
+            print("Response=%s" % hexlify(response))
+        print("%s\n" % dns.message.from_wire(response))
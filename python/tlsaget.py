@@ -5,13 +5,24 @@
 tlsaget.py
 
 Get (print) TLSA records for a hostname or service, resolving MX and/or SRV
-records appropriately if needed.
+records appropriately if needed. Once the MX or SRV answer arrives, the
+TLSA queries for all the targets (and with -a, their address queries)
+are issued concurrently; the output is still printed in the order of the
+MX/SRV answer.
+
+With -f, audit many domains in one run: read "domain[,service][,port]"
+lines from a file (or stdin), resolve them all on one shared Context
+with a limit on the number of queries in flight, and stream one CSV (or
+with -j, JSON) row per TLSA name as the answers arrive. TLSA lookups of
+MX/SRV targets shared by several domains are only done once.
 
 Shumon Huque <shuque@gmail.com>
 """
 
-import getdns, sys, getopt, os.path, pprint
+import getdns, sys, getopt, os.path, pprint, time, csv, json, itertools
+import getdns_cache
 from binascii import hexlify
+from collections import namedtuple, deque
 import dns.rdatatype, dns.rdataclass
 
 
@@ -20,7 +31,22 @@ class Opts:
     port = 443
     transport = 'tcp'
     service = None
+    addresses = False                   # also lookup MX/SRV target addresses
     ext_secure = { "dnssec_return_only_secure" : getdns.EXTENSION_TRUE }
+    filename = None                     # bulk mode input file
+    json = False                        # bulk mode JSON lines output
+    cache = True                        # use getdns_cache response cache
+
+
+SERVICE_PORTS = {
+    'http': 443,
+    'smtp': 25,
+    'xmpp-client': 5222,
+    'xmpp-server': 5269,
+}
+
+STATUS_NAMES = dict((getattr(getdns, x), x[11:]) for x in dir(getdns)
+                    if x.startswith('RESPSTATUS_'))
 
 
 def usage():
@@ -28,11 +54,20 @@ def usage():
     progname = os.path.basename(sys.argv[0])
     print("""\
 Usage: {0} [Options] <domain> [<port>] [<transport>]
+       {0} [Options] -f <file>
 
 Options:
     -s service_name:     lookup relevant service, resolving MX/SRV if needed
                          (Supported: smtp, xmpp-client, xmpp-server)
     -u:                  lookup without DNSSEC validation
+    -a:                  also lookup addresses of MX/SRV targets
+    -f file:             bulk mode, read "domain[,service][,port]" lines
+                         from file ("-" for stdin); -s sets the default
+                         service
+    -c concurrency:      max number of queries in flight in bulk mode
+                         (default 100)
+    -j:                  bulk mode output as JSON lines rather than CSV
+    -n:                  don't use the response cache
 """.format(progname))    
     sys.exit(1)
 
@@ -40,30 +75,36 @@ Options:
 def parse_args(argv):
     """Parse command line arguments"""
     try:
-        (options, args) = getopt.getopt(argv[1:], 's:u')
+        (options, args) = getopt.getopt(argv[1:], 's:uaf:c:jn')
     except getopt.GetoptError:
         usage()
-    else:
-        if not args:
-            usage()
 
     for (opt, optval) in options:
         if opt == '-s':
             Opts.service = optval
-            if Opts.service == 'http': 
-                Opts.port = 443
-            elif Opts.service == 'smtp':
-                Opts.port = 25
-            elif Opts.service == 'xmpp-client':
-                Opts.port = 5222
-            elif Opts.service == 'xmpp-server':
-                Opts.port = 5269
-            else:
+            if Opts.service not in SERVICE_PORTS:
                 print("Error: Unrecognized service name: {}".format(optval))
                 usage()
+            Opts.port = SERVICE_PORTS[Opts.service]
         elif opt == '-u':
             Opts.ext_secure = {}
-
+        elif opt == '-a':
+            Opts.addresses = True
+        elif opt == '-f':
+            Opts.filename = optval
+        elif opt == '-c':
+            Bulk.window = int(optval)
+        elif opt == '-j':
+            Opts.json = True
+        elif opt == '-n':
+            Opts.cache = False
+
+    if Opts.filename:
+        if args:
+            usage()
+        return
+    if not args:
+        usage()
     Opts.hostname = args[0]
     if args[1:]:
         Opts.port = int(args[1])
@@ -84,6 +125,36 @@ def do_query(ctx, qname, qtype):
     return results
 
 
+def do_queries(ctx, queries):
+    """Issue all the given (qname, qtype) queries concurrently, and
+    return the list of results objects in the same order. qtype None
+    means an address lookup. Failed queries have None as results."""
+    results_list = [None] * len(queries)
+
+    def callback(cbtype, results, userarg, tid):
+        index = int(userarg)
+        if cbtype == getdns.CALLBACK_COMPLETE:
+            results_list[index] = results
+        else:
+            print("%s: query failed, callback type %d" %
+                  (queries[index][0], cbtype))
+
+    for (index, (qname, qtype)) in enumerate(queries):
+        try:
+            if qtype is None:
+                ctx.address(name=qname, extensions=Opts.ext_secure,
+                            callback=callback, userarg=str(index))
+            else:
+                ctx.general(name=qname, request_type=qtype,
+                            extensions=Opts.ext_secure,
+                            callback=callback, userarg=str(index))
+        except getdns.error as e:
+            print(str(e))
+            sys.exit(1)
+    ctx.run()
+    return results_list
+
+
 def certdata2hex(certdata):
     """Convert raw TLSA cert association data to hex string"""
     try:
@@ -93,43 +164,74 @@ def certdata2hex(certdata):
     return c
 
 
-def process_answers(results, qtype, qtype_filter=None, do_print=True):
-    """Process answers, print, and return rdata array"""
+class TLSA(namedtuple('TLSA', 'usage selector mtype certdata')):
+    """TLSA rdata; certdata is the raw certificate association data"""
+    __slots__ = ()
+
+    def to_text(self):
+        return "%d %d %d %s" % (self.usage, self.selector, self.mtype,
+                                certdata2hex(self.certdata))
+
+
+class SRV(namedtuple('SRV', 'priority weight port target')):
+    """SRV rdata"""
+    __slots__ = ()
+
+    def to_text(self):
+        return "%d %d %d %s" % self
+
+
+class MX(namedtuple('MX', 'preference exchange')):
+    """MX rdata"""
+    __slots__ = ()
+
+    def to_text(self):
+        return "%d %s" % self
+
+
+def make_record(rrtype, rdata):
+    """Return a typed record for MX, SRV and TLSA rdata, else None"""
+    if rrtype == getdns.RRTYPE_TLSA:
+        return TLSA(rdata['certificate_usage'], rdata['selector'],
+                    rdata['matching_type'],
+                    rdata['certificate_association_data'])
+    elif rrtype == getdns.RRTYPE_SRV:
+        return SRV(rdata['priority'], rdata['weight'], rdata['port'],
+                   rdata['target'])
+    elif rrtype == getdns.RRTYPE_MX:
+        return MX(rdata['preference'], rdata['exchange'])
+    return None
+
+
+def rdata_to_text(rrtype, rdata):
+    """Return presentation format of the rdata of an answer"""
+    if rrtype == getdns.RRTYPE_CNAME:
+        return rdata['cname']
+    record = make_record(rrtype, rdata)
+    return record.to_text() if record else ""
+
+
+def process_answers(results, qtype, qtype_filter=None, do_print=True,
+                    qname=None):
+    """Process answers, print them if do_print, and return a list of
+    typed records (TLSA, SRV or MX) of the given qtype. The text form
+    of the answers is only produced when they are printed."""
     status = results.status
     rdata_list = []
     if status == getdns.RESPSTATUS_GOOD:
         for reply in results.replies_tree:
             answers = reply['answer']
             for answer in answers:
-                rdata = answer['rdata']
-                rdata_p = ""
-                if answer['type'] == getdns.RRTYPE_CNAME:
-                    rdata_p = rdata['cname']
-                elif answer['type'] == getdns.RRTYPE_TLSA:
-                    rdata_p = "%d %d %d %s" % \
-                              (rdata['certificate_usage'],
-                               rdata['selector'], 
-                               rdata['matching_type'],
-                               certdata2hex(rdata['certificate_association_data']))
-                elif answer['type'] == getdns.RRTYPE_SRV:
-                    rdata_p = "%d %d %d %s" % \
-                              (rdata['priority'],
-                               rdata['weight'],
-                               rdata['port'],
-                               rdata['target'])
-                elif answer['type'] == getdns.RRTYPE_MX:
-                    rdata_p = "%d %s" % \
-                              (rdata['preference'],
-                               rdata['exchange'])
-                if answer['type'] == qtype:
-                    rdata_list.append(rdata_p)
-                if do_print and (not qtype_filter or 
-                                 (answer['type'] in qtype_filter)):
+                rrtype = answer['type']
+                if rrtype == qtype:
+                    rdata_list.append(make_record(rrtype, answer['rdata']))
+                if do_print and (not qtype_filter or
+                                 (rrtype in qtype_filter)):
                     print("%s %d %s %s %s" %
                           (answer['name'], answer['ttl'], 
                            dns.rdataclass.to_text(answer['class']),
-                           dns.rdatatype.to_text(answer['type']), 
-                           rdata_p))
+                           dns.rdatatype.to_text(rrtype),
+                           rdata_to_text(rrtype, answer['rdata'])))
 
     elif status == getdns.RESPSTATUS_NO_SECURE_ANSWERS:
         print("%s: No DNSSEC secured responses found" % qname)
@@ -140,54 +242,273 @@ def process_answers(results, qtype, qtype_filter=None, do_print=True):
     return rdata_list
 
 
+def print_addresses(target, results):
+    """Print the addresses of an MX/SRV target"""
+    if results.status == getdns.RESPSTATUS_GOOD:
+        for addr in results.just_address_answers:
+            print("%s %s %s" % (target, addr['address_type'],
+                                addr['address_data']))
+    elif results.status == getdns.RESPSTATUS_NO_SECURE_ANSWERS:
+        print("%s: No DNSSEC secured address responses found" % target)
+    else:
+        print("%s: getdns.address() returned error: %d" %
+              (target, results.status))
+
+
+def lookup_targets(ctx, targets):
+    """Lookup TLSA records (and with -a, addresses) for a list of
+    (port, target) tuples concurrently, and print them in order"""
+    queries = []
+    for (port, target) in targets:
+        queries.append(("_%s._tcp.%s" % (port, target), getdns.RRTYPE_TLSA))
+        if Opts.addresses:
+            queries.append((target, None))
+    results_list = iter(do_queries(ctx, queries))
+    for (qname, qtype) in queries:
+        results = next(results_list)
+        if results is None:
+            continue
+        if qtype is None:
+            print_addresses(qname, results)
+        else:
+            process_answers(results, getdns.RRTYPE_TLSA,
+                            [getdns.RRTYPE_TLSA, getdns.RRTYPE_CNAME],
+                            qname=qname)
+
+
+class Bulk:
+    """State of the bulk (-f) mode"""
+    window          = 100           # max number of queries in flight
+    ctx             = None          # the shared getdns Context
+    jobs            = None          # iterator of (domain, service, port)
+    inflight        = 0
+    userargs        = dict()        # userarg -> (kind, data) of queries
+    ids             = itertools.count()
+    tlsa_names      = deque()       # TLSA names waiting to be queried
+    waiting         = dict()        # TLSA name -> rows waiting for it
+    writer          = None          # csv writer, if not JSON output
+    domain_count    = 0
+    row_count       = 0
+    tlsa_rows       = 0             # rows for a TLSA name
+    secured_count   = 0             # rows with TLSA records
+    tlsa_lookups    = 0
+
+
+def read_jobs(f):
+    """Generate (domain, service, port) tuples from a file object of
+    domain[,service][,port] lines"""
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = [x.strip() for x in line.split(',')]
+        domain = fields[0]
+        service = (fields[1:] and fields[1]) or Opts.service
+        if service and service not in SERVICE_PORTS:
+            sys.stderr.write("%s: unrecognized service name: %s\n" %
+                             (domain, service))
+            continue
+        try:
+            if fields[2:] and fields[2]:
+                port = int(fields[2])
+            elif service:
+                port = SERVICE_PORTS[service]
+            else:
+                port = Opts.port
+        except ValueError:
+            sys.stderr.write("%s: bad port: %s\n" % (domain, fields[2]))
+            continue
+        yield (domain, service, port)
+
+
+def status_name(cbtype, results):
+    """Return name of the outcome of a bulk mode query"""
+    if cbtype == getdns.CALLBACK_COMPLETE:
+        return STATUS_NAMES.get(results.status, str(results.status))
+    elif cbtype == getdns.CALLBACK_TIMEOUT:
+        return "TIMEOUT"
+    elif cbtype == getdns.CALLBACK_CANCEL:
+        return "CANCEL"
+    return "ERROR"
+
+
+def write_row(row, tlsa_name, status, records):
+    """Write one bulk mode output row, for a TLSA name of a domain"""
+    domain, service, port, target = row
+    if Opts.json:
+        tlsa = [dict(usage=r.usage, selector=r.selector, mtype=r.mtype,
+                     data=certdata2hex(r.certdata)) for r in records]
+        sys.stdout.write(json.dumps(dict(domain=domain, service=service,
+                                         port=port, target=target,
+                                         tlsa_name=tlsa_name, status=status,
+                                         tlsa=tlsa)) + "\n")
+    else:
+        Bulk.writer.writerow([domain, service or "", port, target, tlsa_name,
+                              status, ";".join(r.to_text() for r in records)])
+    Bulk.row_count += 1
+    if tlsa_name:
+        Bulk.tlsa_rows += 1
+    if records:
+        Bulk.secured_count += 1
+
+
+def bulk_submit(ctx, qname, qtype, kind, data):
+    """Submit an async query in bulk mode; returns False on failure"""
+    userarg = str(next(Bulk.ids))
+    Bulk.userargs[userarg] = (kind, data)
+    try:
+        ctx.general(name=qname, request_type=qtype,
+                    extensions=Opts.ext_secure, callback=bulk_callback,
+                    userarg=userarg)
+    except getdns.error as e:
+        del Bulk.userargs[userarg]
+        sys.stderr.write("%s: %s\n" % (qname, e))
+        return False
+    Bulk.inflight += 1
+    return True
+
+
+def queue_tlsa(tlsa_name, row):
+    """Arrange for a row to be written once tlsa_name is resolved. Rows
+    share a lookup that is queued or in flight; results are not kept
+    after their rows are written, so memory stays bounded by the window
+    rather than growing with the job file."""
+    if tlsa_name in Bulk.waiting:
+        Bulk.waiting[tlsa_name].append(row)
+    else:
+        Bulk.waiting[tlsa_name] = [row]
+        Bulk.tlsa_names.append(tlsa_name)
+
+
+def finish_tlsa(tlsa_name, status, records):
+    """Write the rows waiting for the outcome of a TLSA lookup"""
+    for row in Bulk.waiting.pop(tlsa_name, []):
+        write_row(row, tlsa_name, status, records)
+
+
+def fill_window(ctx):
+    """Submit queued TLSA queries, then queries for new domains, until
+    the window is full"""
+    while Bulk.inflight < Bulk.window:
+        if Bulk.tlsa_names:
+            tlsa_name = Bulk.tlsa_names.popleft()
+            if bulk_submit(ctx, tlsa_name, getdns.RRTYPE_TLSA,
+                           'tlsa', tlsa_name):
+                Bulk.tlsa_lookups += 1
+            else:
+                finish_tlsa(tlsa_name, "ERROR", [])
+        elif Bulk.jobs is not None:
+            try:
+                job = next(Bulk.jobs)
+            except StopIteration:
+                Bulk.jobs = None
+                break
+            Bulk.domain_count += 1
+            domain, service, port = job
+            if service == 'smtp':
+                ok = bulk_submit(ctx, domain, getdns.RRTYPE_MX, 'mx', job)
+            elif service in ['xmpp-client', 'xmpp-server']:
+                ok = bulk_submit(ctx, "_%s._tcp.%s" % (service, domain),
+                                 getdns.RRTYPE_SRV, 'srv', job)
+            else:
+                queue_tlsa("_%d._%s.%s" % (port, Opts.transport, domain),
+                           (domain, service, port, domain))
+                ok = True
+            if not ok:
+                write_row((domain, service, port, ""), "", "ERROR", [])
+        else:
+            break
+    return
+
+
+def bulk_callback(cbtype, results, userarg, tid):
+    """Callback for bulk mode queries: write out rows for TLSA answers,
+    and queue TLSA lookups for the targets of MX/SRV answers"""
+    Bulk.inflight -= 1
+    kind, data = Bulk.userargs.pop(userarg)
+    status = status_name(cbtype, results)
+    good = (status == "GOOD")
+    if kind == 'tlsa':
+        records = process_answers(results, getdns.RRTYPE_TLSA,
+                                  do_print=False) if good else []
+        finish_tlsa(data, status, records)
+    else:
+        domain, service, port = data
+        targets = []
+        if kind == 'mx' and good:
+            for mx in process_answers(results, getdns.RRTYPE_MX,
+                                      do_print=False):
+                targets.append((port, mx.exchange.lower()))
+        elif good:
+            for srv in process_answers(results, getdns.RRTYPE_SRV,
+                                       do_print=False):
+                targets.append((srv.port, srv.target.lower()))
+        targets = sorted(set(t for t in targets if t[1] != "."))
+        if good and not targets:
+            status = "NO_TARGETS"
+        if not targets:
+            write_row((domain, service, port, ""), "", status, [])
+        for (tport, target) in targets:
+            queue_tlsa("_%d._tcp.%s" % (tport, target),
+                       (domain, service, tport, target))
+    fill_window(Bulk.ctx)
+
+
+def bulk_audit(ctx):
+    """Run the bulk (-f) mode"""
+    t1 = time.time()
+    Bulk.ctx = ctx
+    f = sys.stdin if Opts.filename == '-' else open(Opts.filename)
+    if not Opts.json:
+        Bulk.writer = csv.writer(sys.stdout, lineterminator="\n")
+        Bulk.writer.writerow(["domain", "service", "port", "target",
+                              "tlsa_name", "status", "tlsa"])
+    Bulk.jobs = read_jobs(f)
+    fill_window(ctx)
+    ctx.run()
+    sys.stdout.flush()
+    sys.stderr.write("%d domains, %d rows, %d with TLSA records, "
+                     "%d TLSA lookups (%d shared), %.3fs\n" %
+                     (Bulk.domain_count, Bulk.row_count, Bulk.secured_count,
+                      Bulk.tlsa_lookups,
+                      Bulk.tlsa_rows - Bulk.tlsa_lookups,
+                      time.time() - t1))
+
+
 if __name__ == '__main__':
 
     parse_args(sys.argv)
 
+    if Opts.filename:
+        bulk_audit(getdns.Context())
+        sys.exit(0)
+
     ctx = getdns.Context()
+    if Opts.cache:
+        ctx = getdns_cache.CachingContext(ctx)
 
     if not Opts.service or Opts.service == 'http':
 
         qname = "_%d._%s.%s" % (Opts.port, Opts.transport, Opts.hostname)
         results = do_query(ctx, qname, getdns.RRTYPE_TLSA)
         x = process_answers(results, getdns.RRTYPE_TLSA,
-                            [getdns.RRTYPE_TLSA, getdns.RRTYPE_CNAME])
+                            [getdns.RRTYPE_TLSA, getdns.RRTYPE_CNAME],
+                            qname=qname)
 
     elif Opts.service == 'smtp':
 
-        results = do_query(ctx, Opts.hostname, getdns.RRTYPE_MX)
+        qname = Opts.hostname
+        results = do_query(ctx, qname, getdns.RRTYPE_MX)
         x = process_answers(results, getdns.RRTYPE_MX,
-                            [getdns.RRTYPE_MX, getdns.RRTYPE_CNAME])
-        for entry in x:
-            mx = entry.split()[1]
-            qname = "_25._tcp.%s" % mx
-            results = do_query(ctx, qname, getdns.RRTYPE_TLSA)
-            y = process_answers(results, getdns.RRTYPE_TLSA,
-                                [getdns.RRTYPE_TLSA, getdns.RRTYPE_CNAME])
-
-    elif Opts.service == 'xmpp-client':
-
-        qname = "_xmpp-client._tcp.%s" % (Opts.hostname)
-        results = do_query(ctx, qname, getdns.RRTYPE_SRV)
-        x = process_answers(results, getdns.RRTYPE_SRV,
-                            [getdns.RRTYPE_SRV, getdns.RRTYPE_CNAME])
-        for entry in x:
-            prio, weight, port, target = entry.split()
-            qname = "_%s._tcp.%s" % (port, target)
-            results = do_query(ctx, qname, getdns.RRTYPE_TLSA)
-            y = process_answers(results, getdns.RRTYPE_TLSA,
-                                [getdns.RRTYPE_TLSA, getdns.RRTYPE_CNAME])
+                            [getdns.RRTYPE_MX, getdns.RRTYPE_CNAME],
+                            qname=qname)
+        lookup_targets(ctx, [(25, mx.exchange) for mx in x])
 
-    elif Opts.service == 'xmpp-server':
+    elif Opts.service in ['xmpp-client', 'xmpp-server']:
 
-        qname = "_xmpp-server._tcp.%s" % (Opts.hostname)
+        qname = "_%s._tcp.%s" % (Opts.service, Opts.hostname)
         results = do_query(ctx, qname, getdns.RRTYPE_SRV)
         x = process_answers(results, getdns.RRTYPE_SRV,
-                            [getdns.RRTYPE_SRV, getdns.RRTYPE_CNAME])
-        for entry in x:
-            prio, weight, port, target = entry.split()
-            qname = "_%s._tcp.%s" % (port, target)
-            results = do_query(ctx, qname, getdns.RRTYPE_TLSA)
-            y = process_answers(results, getdns.RRTYPE_TLSA,
-                                [getdns.RRTYPE_TLSA, getdns.RRTYPE_CNAME])
-
+                            [getdns.RRTYPE_SRV, getdns.RRTYPE_CNAME],
+                            qname=qname)
+        lookup_targets(ctx, [(srv.port, srv.target) for srv in x])
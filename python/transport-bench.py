@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+
+"""
+transport-bench.py
+
+Offline benchmark of getdns_query.py over the UDP (-U), TCP (-T),
+TCP keep-open (-O), TLS (-L) and TLS with TCP fallback (-E)
+transports. Starts a stand-in DNS server (dns_standin.py) on the
+loopback address with a self-signed TLS certificate, runs
+getdns_query.py in async stub mode against it with a generated query
+file at each concurrency level (-W), and records qps and latency
+percentiles from the summary it prints.
+
+getdns_query.py needs the getdns python bindings; use -P to name a
+python interpreter that has them if it isn't the one running this.
+
+An example run, printing one line per transport and concurrency level:
+$ transport-bench.py -n 2000 -c 1,10,100 -t UDP,TLS -o results.csv
+
+Shumon Huque <shuque@gmail.com>
+"""
+
+import os, os.path, sys, getopt, re, csv, subprocess, tempfile
+import dns_standin
+
+
+TRANSPORTS = [
+    ('UDP', '-U'),
+    ('TCP', '-T'),
+    ('TCP-keepopen', '-O'),
+    ('TLS', '-L'),
+    ('TLS-TCP', '-E'),
+]
+
+QUERIES_RE = re.compile(r'^Queries: (\d+) \(([\d.]+) qps\)')
+LATENCY_RE = re.compile(r'^Latency: p50 ([\d.]+)ms p90 ([\d.]+)ms '
+                        r'p99 ([\d.]+)ms max ([\d.]+)ms')
+GOOD_RE = re.compile(r'^\s+GOOD\s+(\d+)\s')
+
+FIELDS = ['transport', 'concurrency', 'queries', 'good', 'qps',
+          'p50', 'p90', 'p99', 'max']
+
+
+class Opts:
+    nqueries = 1000
+    concurrency = [1, 10, 100]
+    transports = [x[0] for x in TRANSPORTS]
+    delay = 0
+    python = sys.executable
+    outfile = None
+
+
+def usage():
+    print("""\
+Usage: {0} [Options]
+
+Options:
+    -n nqueries:      number of queries per run (default 1000)
+    -c levels:        comma separated concurrency levels (default 1,10,100)
+    -t transports:    comma separated subset of {1}
+    -d delay_ms:      stand-in server answer delay (default 0)
+    -P python:        interpreter to run getdns_query.py with
+    -o file:          also write results to file as CSV
+""".format(os.path.basename(sys.argv[0]),
+           ",".join(x[0] for x in TRANSPORTS)))
+    sys.exit(1)
+
+
+def parse_args(argv):
+    """Parse command line arguments"""
+    try:
+        (options, args) = getopt.getopt(argv[1:], 'n:c:t:d:P:o:')
+    except getopt.GetoptError:
+        usage()
+    if args:
+        usage()
+
+    known = dict(TRANSPORTS)
+    for (opt, optval) in options:
+        if opt == '-n':
+            Opts.nqueries = int(optval)
+        elif opt == '-c':
+            Opts.concurrency = [int(x) for x in optval.split(',')]
+        elif opt == '-t':
+            Opts.transports = optval.split(',')
+            for t in Opts.transports:
+                if t not in known:
+                    print("Error: Unknown transport: {}".format(t))
+                    usage()
+        elif opt == '-d':
+            Opts.delay = int(optval)
+        elif opt == '-P':
+            Opts.python = optval
+        elif opt == '-o':
+            Opts.outfile = optval
+    return
+
+
+def write_query_file(f, nqueries):
+    """Write nqueries distinct A and AAAA queries to file object f"""
+    for i in range(nqueries):
+        qtype = 'A' if i % 2 == 0 else 'AAAA'
+        f.write("q{}.bench.example. {}\n".format(i, qtype))
+    f.flush()
+
+
+def run_one(server, queryfile, transport, concurrency):
+    """Run getdns_query.py once, and return a result dictionary parsed
+    from its summary output"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "getdns_query.py")
+    cmd = [Opts.python, script, '-s', '-a', '-q', '-n',
+           '-W', str(concurrency), '-F', queryfile,
+           dict(TRANSPORTS)[transport],
+           "@{}@{}#{}".format(server.address, server.port, server.tls_port)]
+    output = subprocess.check_output(cmd, universal_newlines=True)
+
+    result = dict(transport=transport, concurrency=concurrency,
+                  queries=0, good=0, qps=0.0,
+                  p50=None, p90=None, p99=None, max=None)
+    for line in output.splitlines():
+        m = QUERIES_RE.match(line)
+        if m:
+            result['queries'] = int(m.group(1))
+            result['qps'] = float(m.group(2))
+            continue
+        m = LATENCY_RE.match(line)
+        if m:
+            for key, value in zip(('p50', 'p90', 'p99', 'max'), m.groups()):
+                result[key] = float(value)
+            continue
+        m = GOOD_RE.match(line)
+        if m:
+            result['good'] = int(m.group(1))
+    return result
+
+
+def print_result(r):
+    if r['p50'] is None:
+        print("{:<14} {:>5} {:>8}  no summary from getdns_query.py".format(
+            r['transport'], r['concurrency'], r['queries']))
+        return
+    print("{:<14} {:>5} {:>8} {:>9.1f} {:>6.1f}ms {:>6.1f}ms {:>6.1f}ms "
+          "{:>6.1f}ms".format(r['transport'], r['concurrency'],
+                              r['queries'], r['qps'], r['p50'], r['p90'],
+                              r['p99'], r['max']))
+
+
+if __name__ == '__main__':
+
+    parse_args(sys.argv)
+
+    server = dns_standin.StandinServer(tls_port=0,
+                                       delay=Opts.delay / 1000.0)
+    server.start()
+
+    queryfile = tempfile.NamedTemporaryFile(mode='w', suffix='.txt')
+    write_query_file(queryfile, Opts.nqueries)
+
+    results = []
+    print("{:<14} {:>5} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8}".format(
+        'transport', 'conc', 'queries', 'qps', 'p50', 'p90', 'p99', 'max'))
+    try:
+        for transport in Opts.transports:
+            for concurrency in Opts.concurrency:
+                r = run_one(server, queryfile.name, transport, concurrency)
+                if r['good'] != r['queries']:
+                    print("WARNING: {} of {} queries failed".format(
+                        r['queries'] - r['good'], r['queries']))
+                print_result(r)
+                results.append(r)
+    finally:
+        queryfile.close()
+        server.stop()
+
+    if Opts.outfile:
+        with open(Opts.outfile, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(results)